@@ -4,95 +4,716 @@ Reference:  Iterative Normalization: Beyond Standardization towards Efficient Wh
 - Paper:
 - Code: https://github.com/huangleiBuaa/IterNorm
 """
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import functools
+import time
 import torch.nn
 import torch.nn.functional as F
+import torch.distributed as dist
 from torch.nn import Parameter
 
 # import extension._bcnn as bcnn
 
-__all__ = ['iterative_normalization', 'IterNorm']
+__all__ = ['iterative_normalization', 'IterNorm', 'SyncIterNormRotation', 'select_whitening_backend',
+           'update_rotation_matrices', 'AsyncRotationUpdater']
+
+
+def _symeig(A):
+    """
+    Batched symmetric eigendecomposition, returns (eigenvalues, eigenvectors)
+    """
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'eigh'):
+        return torch.linalg.eigh(A)
+    return torch.symeig(A, eigenvectors=True)
+
+
+def _qr(A):
+    """
+    Batched QR decomposition, returns (Q, R)
+    """
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'qr'):
+        return torch.linalg.qr(A)
+    return torch.qr(A)
+
+
+def _cholesky_factors(A):
+    """
+    Batched Cholesky factor L of A and its inverse L^{-1}
+    """
+    I = torch.eye(A.size(-1)).to(A).expand_as(A)
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'solve_triangular'):
+        L = torch.linalg.cholesky(A)
+        return L, torch.linalg.solve_triangular(L, I, upper=False)
+    L = torch.cholesky(A)
+    return L, torch.triangular_solve(I, L, upper=False)[0]
+
+
+def _workspace(ctx, like, n):
+    """
+    n scratch tensors shaped like `like`, cached in ctx.workspace per (g, d, dtype, device)
+    """
+    if ctx.workspace is None:
+        return [torch.empty_like(like) for _ in range(n)]
+    key = tuple(like.size()) + (like.dtype, like.device)
+    buffers = ctx.workspace.get(key)
+    if buffers is None or len(buffers) < n:
+        buffers = ctx.workspace[key] = [torch.empty_like(like) for _ in range(n)]
+    return buffers[:n]
+
+
+# inputs in these dtypes are whitened with float32 statistics
+_REDUCED_PRECISION = (torch.float16, torch.bfloat16)
+
+
+def _stats_dtype(X):
+    """
+    dtype in which the whitening statistics of X are computed
+    """
+    return torch.float32 if X.dtype in _REDUCED_PRECISION else X.dtype
+
+
+def _autocast_dtype(device_type):
+    """
+    The dtype autocast casts to on device_type, None when autocast is not enabled there
+    """
+    if device_type == 'cuda' and hasattr(torch, 'is_autocast_enabled') and torch.is_autocast_enabled():
+        return torch.get_autocast_gpu_dtype() if hasattr(torch, 'get_autocast_gpu_dtype') else torch.float16
+    if device_type == 'cpu' and hasattr(torch, 'is_autocast_cpu_enabled') and torch.is_autocast_cpu_enabled():
+        return torch.get_autocast_cpu_dtype()
+    return None
+
+
+def _whitening_precision(X):
+    """
+    (input, context) to run the whitening function on X with. Under autocast, X is cast to the autocast
+    dtype and autocast is turned off inside the function, which keeps its statistics in float32
+    """
+    dtype = _autocast_dtype(X.device.type)
+    if dtype is None:
+        return X, contextlib.suppress()
+    if hasattr(torch, 'autocast'):
+        return X.to(dtype), torch.autocast(X.device.type, enabled=False)
+    return X.to(dtype), torch.cuda.amp.autocast(enabled=False)
+
+
+# The backward of the whitening function runs with the autocast state of its forward (off, see _whitening_precision),
+# also when it is called under autocast
+if hasattr(torch, 'amp') and hasattr(torch.amp, 'custom_fwd'):
+    _custom_fwd = functools.partial(torch.amp.custom_fwd, device_type='cuda')
+    _custom_bwd = functools.partial(torch.amp.custom_bwd, device_type='cuda')
+elif hasattr(torch.cuda, 'amp') and hasattr(torch.cuda.amp, 'custom_fwd'):
+    _custom_fwd, _custom_bwd = torch.cuda.amp.custom_fwd, torch.cuda.amp.custom_bwd
+else:
+    # torch without autocast
+    _custom_fwd = _custom_bwd = lambda fn: fn
+
+
+# Whitening backends. Each backend turns the covariance Sigma [g, d, d] into a whitening
+# matrix wm, and maps the gradient of wm back to the (symmetric) gradient of Sigma.
+#   forward(ctx, Sigma) -> wm, state
+#   backward(ctx, g_wm, wm, state) -> g_Sigma
+
+def _newton_schulz_iterations(Sigma_N, P, wm, t1, t2, tol=None):
+    """
+    Newton-Schulz steps P_{k+1} = 1.5 P_k - 0.5 P_k^3 Sigma_N, written into preallocated tensors.
+    P [T, g, d, d] holds P_0 on entry and receives P_1 ... P_{T-1}, wm receives the last iterate.
+    t1 and t2 are scratch tensors of shape [g, d, d].
+    With a tolerance, the iteration stops as soon as the residual ||P_k^3 Sigma_N - P_k|| (largest
+    over groups) drops below tol. Returns the number of steps taken.
+    """
+    T = P.size(0)
+    for k in range(T):
+        out = P[k + 1] if k + 1 < T else wm
+        torch.bmm(P[k], P[k], out=t1)
+        torch.bmm(t1, P[k], out=t2)
+        torch.baddbmm(P[k], t2, Sigma_N, beta=1.5, alpha=-0.5, out=out)
+        if tol is not None and k + 1 < T:
+            # P_{k+1} - P_k = -0.5 (P_k^3 Sigma_N - P_k)
+            residual = 2. * torch.sub(out, P[k], out=t1).view(t1.size(0), -1).norm(dim=1).max()
+            if residual.item() < tol:
+                wm.copy_(out)
+                return k + 1
+    return T
+
+
+def _newton_schulz_gradient(g_P, sn, P, g_sn, P2, t, g_tmp):
+    """
+    Back-propagate through the Newton-Schulz steps in place. g_P holds the gradient of the last
+    iterate on entry, g_sn receives the gradient of the normalized Sigma (up to the factor -0.5).
+    P2, t and g_tmp are scratch tensors of shape [g, d, d].
+    """
+    g_sn.zero_()
+    for k in range(P.size(0) - 1, 0, -1):
+        Pk = P[k].transpose(-2, -1)
+        torch.bmm(Pk, Pk, out=P2)
+        torch.bmm(P2, Pk, out=t)
+        g_sn.baddbmm_(t, g_P)
+        torch.bmm(g_P, sn, out=g_tmp)
+        g_P.baddbmm_(g_tmp, P2, beta=1.5, alpha=-0.5)
+        g_P.baddbmm_(P2, g_tmp, alpha=-0.5)
+        torch.bmm(Pk, g_tmp, out=t)
+        g_P.baddbmm_(t, Pk, alpha=-0.5)
+    return g_sn.add_(g_P)
+
+
+def _newton_schulz_forward(ctx, Sigma):
+    g, d, _ = Sigma.size()
+    # reciprocal of trace of Sigma: shape [g, 1, 1]
+    rTr = Sigma.diagonal(dim1=-2, dim2=-1).sum(-1).reciprocal_().view(g, 1, 1)
+    Sigma_N = Sigma * rTr
+    P = Sigma.new_empty(ctx.T, g, d, d)
+    P[0].copy_(torch.eye(d).to(Sigma).expand(g, d, d))
+    t1, t2 = _workspace(ctx, Sigma, 2)
+    wm = torch.empty_like(Sigma)
+    iterations = _newton_schulz_iterations(Sigma_N, P, wm, t1, t2, ctx.tol)
+    if ctx.info is not None:
+        ctx.info['iterations'] = iterations
+    wm.mul_(rTr.sqrt())  # whiten matrix: the matrix inverse of Sigma, i.e., Sigma^{-1/2}
+    # backward only walks through the iterations actually taken
+    return wm, [rTr, Sigma_N, P[:iterations]]
+
+
+def _newton_schulz_backward(ctx, g_wm, wm, state):
+    rTr, Sigma_N, P = state  # reciprocal trace of Sigma, normalized Sigma, middle result matrices
+    g_P, g_sn, P2, t, g_tmp = _workspace(ctx, g_wm, 5)
+    torch.mul(g_wm, rTr.sqrt(), out=g_P)
+    _newton_schulz_gradient(g_P, Sigma_N.transpose(-2, -1), P, g_sn, P2, t, g_tmp)
+    # gradient of the trace: tr(g_wm^T wm) - tr(Sigma_N^T g_sn)
+    g_tr = (g_wm * wm).sum((1, 2), keepdim=True) - (Sigma_N * g_sn).sum((1, 2), keepdim=True)
+    g_sigma = g_sn + g_sn.transpose(-2, -1)
+    g_sigma.diagonal(dim1=-2, dim2=-1).add_(2. * g_tr.view(-1, 1))
+    return g_sigma.mul_(-0.25 * rTr)
+
+
+def _eigh_forward(ctx, Sigma):
+    # ZCA whitening: wm = U diag(s^-1) U^T with s = sqrt(eigenvalues)
+    eig, U = _symeig(Sigma)
+    s = eig.clamp(min=ctx.eps).sqrt()
+    wm = (U / s.unsqueeze(-2)).matmul(U.transpose(-2, -1))
+    return wm, [U, s]
+
+
+def _eigh_backward(ctx, g_wm, wm, state):
+    U, s = state
+    # Daleckii-Krein: (f(l_i) - f(l_j)) / (l_i - l_j) for f(l) = l^{-1/2}, free of eigen-gaps
+    s_i, s_j = s.unsqueeze(-1), s.unsqueeze(-2)
+    K = -1. / (s_i * s_j * (s_i + s_j))
+    g_u = U.transpose(-2, -1).matmul(g_wm).matmul(U)
+    g_u = 0.5 * (g_u + g_u.transpose(-2, -1)) * K
+    return U.matmul(g_u).matmul(U.transpose(-2, -1))
+
+
+def _cholesky_forward(ctx, Sigma):
+    # Cholesky whitening: Sigma = L L^T, wm = L^{-1}
+    L, wm = _cholesky_factors(Sigma)
+    return wm, [L]
+
+
+def _cholesky_backward(ctx, g_wm, wm, state):
+    L, = state
+    wm_t = wm.transpose(-2, -1)
+    g_L = torch.tril(-wm_t.matmul(g_wm).matmul(wm_t))
+    phi = L.transpose(-2, -1).matmul(g_L)
+    phi = torch.tril(phi) - 0.5 * torch.diag_embed(phi.diagonal(dim1=-2, dim2=-1))
+    g_sigma = wm_t.matmul(phi).matmul(wm)
+    return 0.5 * (g_sigma + g_sigma.transpose(-2, -1))
+
+
+_whitening_backends = {
+    'newton': (_newton_schulz_forward, _newton_schulz_backward),
+    'eigh': (_eigh_forward, _eigh_backward),
+    'cholesky': (_cholesky_forward, _cholesky_backward),
+}
+
+
+def _covariance(ctx, xc):
+    """
+    Covariance of the centered activation xc [g, d, m], with eps added on the diagonal
+    """
+    g, d, m = xc.size()
+    I = torch.eye(d).to(xc).expand(g, d, d)
+    return torch.baddbmm(ctx.eps, I, 1. / m, xc, xc.transpose(1, 2))
+
+
+# Layout-aware path: works on the memory of X directly instead of a transposed (g, d, m) copy.
+# NCHW memory is viewed as [N, g, d, HW], channels_last memory as [NHW, g, d].
+
+def _layout_view(X, nc, channels_last):
+    """
+    View X [N, C, H, W] as [N, g, d, HW] (NCHW memory) or [NHW, g, d] (channels_last memory)
+    """
+    if channels_last:
+        X = X.contiguous(memory_format=torch.channels_last)
+        return X.permute(0, 2, 3, 1).view(-1, X.size(1) // nc, nc)
+    return X.contiguous().view(X.size(0), X.size(1) // nc, nc, -1)
+
+
+def _layout_restore(y, size, channels_last):
+    """
+    Inverse of _layout_view for an output y of the same layout
+    """
+    if channels_last:
+        return y.reshape(size[0], size[2], size[3], size[1]).permute(0, 3, 1, 2)
+    return y.view(size)
+
+
+def _spatial_subset(ctx, x):
+    """
+    The window (a slice) of positions of the layout view x the statistics are estimated from, None for all of them.
+    On NCHW memory it is a block of the flattened H x W positions of every map, on channels_last memory a block of
+    the N x H x W rows, so that the subsampled columns are a view of x. 'fixed' takes the central block, 'random'
+    one at a new offset at every call.
+    """
+    if ctx.subsample is None or ctx.subsample >= 1.:
+        return None
+    length = x.size(0) if x.dim() == 3 else x.size(3)
+    k = max(1, int(round(ctx.subsample * length)))
+    if ctx.subsample_mode == 'random':
+        start = int(torch.randint(length - k + 1, (1,)))
+    else:
+        start = (length - k) // 2
+    return slice(start, start + k)
+
+
+def _layout_subsample(x, subset):
+    """
+    Columns of the layout view x in the window subset, a view in the same layout
+    """
+    if subset is None:
+        return x
+    if x.dim() == 3:
+        return x[subset]
+    return x[..., subset]
+
+
+def _layout_apply_add_(out, A, x, b):
+    """
+    out += A x_j + b for every column j, in place. out and x are layout views, e.g. windows of larger ones
+    """
+    if x.dim() == 3:
+        M, g, d = x.size()
+        if g == 1:
+            out.view(M, d).addmm_(x.view(M, d), A[0].t()).add_(b.view(1, d))
+        else:
+            out.transpose(0, 1).baddbmm_(x.transpose(0, 1), A.transpose(1, 2)).add_(b.transpose(1, 2))
+        return out
+    N, g, d, k = x.size()
+    # the window is not contiguous, the product of A goes through a temporary of its size
+    out.add_(F.conv1d(x.reshape(N, g * d, k), A.reshape(g * d, d, 1), b.reshape(g * d), groups=g).view(N, g, d, k))
+    return out
+
+
+def _layout_sum(x):
+    """
+    Sum over the columns of x, shape [g, d, 1]
+    """
+    if x.dim() == 3:
+        return x.sum(0, dtype=_stats_dtype(x)).unsqueeze(-1)
+    return x.sum((0, 3), dtype=_stats_dtype(x)).unsqueeze(-1)
+
+
+def _layout_gram(x, y):
+    """
+    sum_j x_j y_j^T over the columns of x and y, shape [g, d, d].
+    Reduced-precision inputs are upcast chunk by chunk, at most 1/8 of the activation at a time.
+    """
+    upcast = x.dtype in _REDUCED_PRECISION
+    if x.dim() == 3:
+        M, g, d = x.size()
+        out = x.new_zeros(g, d, d, dtype=_stats_dtype(x))
+        r = max(1, M // 8) if upcast else M
+        for i in range(0, M, r):
+            xi = x[i:i + r].to(out.dtype)
+            yi = y[i:i + r].to(out.dtype)
+            if g == 1:
+                # a single GEMM over the [NHW, d] view
+                out[0].addmm_(xi.view(-1, d).t(), yi.view(-1, d))
+            else:
+                # [r, g, d] -> [g, r, d] is a strided view that bmm reads without a copy
+                out.baddbmm_(xi.transpose(0, 1).transpose(1, 2), yi.transpose(0, 1))
+        return out
+    N, g, d, hw = x.size()
+    out = x.new_zeros(g, d, d, dtype=_stats_dtype(x))
+    if hw < d:
+        # per-sample [d, d] partials would be larger than the samples themselves: accumulate one GEMM per
+        # chunk of 1/8 of the batch instead, over a transposed [g, d, b * HW] copy of the chunk
+        b = max(1, N // 8)
+        for i in range(0, N, b):
+            xi = x[i:i + b].permute(1, 2, 0, 3).reshape(g, d, -1).to(out.dtype)
+            yi = xi if y is x else y[i:i + b].permute(1, 2, 0, 3).reshape(g, d, -1).to(out.dtype)
+            out.baddbmm_(xi, yi.transpose(1, 2))
+        return out
+    # chunk the batch so that the [b * g, d, d] partial products are never larger than x
+    b = max(1, min(N, N * hw // d))
+    if upcast:
+        b = max(1, min(b, N // 8))
+    for i in range(0, N, b):
+        xi = x[i:i + b].reshape(-1, d, hw).to(out.dtype)
+        yi = y[i:i + b].reshape(-1, d, hw).to(out.dtype)
+        out += torch.bmm(xi, yi.transpose(1, 2)).view(-1, g, d, d).sum(0)
+    return out
+
+
+def _layout_apply(A, x, b, B=None, y=None):
+    """
+    A x_j + b (+ B y_j) for every column j, returned in the layout of x. A, B: [g, d, d], b: [g, d, 1]
+    """
+    if x.dim() == 3:
+        M, g, d = x.size()
+        if g == 1:
+            out = torch.addmm(b.view(1, d), x.view(M, d), A[0].t())
+            if B is not None:
+                out.addmm_(y.view(M, d), B[0].t())
+            return out.view(M, 1, d)
+        out = torch.baddbmm(b.transpose(1, 2), x.transpose(0, 1), A.transpose(1, 2))
+        if B is not None:
+            out.baddbmm_(y.transpose(0, 1), B.transpose(1, 2))
+        return out.transpose(0, 1)
+    # a grouped 1x1 convolution on the NCHW memory, A is not repeated for every sample
+    N, g, d, hw = x.size()
+    out = F.conv1d(x.reshape(N, g * d, hw), A.reshape(g * d, d, 1), b.reshape(g * d), groups=g)
+    if B is not None:
+        out.add_(F.conv1d(y.reshape(N, g * d, hw), B.reshape(g * d, d, 1), groups=g))
+    return out.view(N, g, d, hw)
+
+
+def _all_reduce(group, *tensors):
+    """
+    Sum the tensors over the processes of group, packed into a single collective
+    """
+    flat = torch.cat([t.reshape(-1) for t in tensors])
+    dist.all_reduce(flat, group=group)
+    return [r.view_as(t) for r, t in zip(flat.split([t.numel() for t in tensors]), tensors)]
+
+
+def _moments(ctx, x, m):
+    """
+    Raw moments of the m columns of x: sum of outer products [g, d, d], sum [g, d, 1] and number of samples.
+    With ctx.process_group they are summed over its processes first, i.e. they are those of the global batch;
+    ctx.pooled, the moments of the previous micro-batches of the accumulation window, is added on top.
+    """
+    s = _layout_sum(x)
+    S = _layout_gram(x, x)
+    n = m
+    if ctx.process_group is not None:
+        S, s, n = _all_reduce(ctx.process_group, S, s, s.new_full((1,), m))
+        n = n.item()
+    if ctx.pooled is not None:
+        S_p, s_p, n_p = ctx.pooled
+        S, s, n = S + S_p, s + s_p, n + n_p
+    return S, s, n
+
+
+def _mean_covariance(ctx, S, s, n):
+    """
+    Mean and covariance from the raw moments, E[x x^T] - mean mean^T, with eps added on the diagonal
+    """
+    mean = s / n
+    Sigma = torch.baddbmm(S, mean, mean.transpose(1, 2), beta=1. / n, alpha=-1.)
+    Sigma.diagonal(dim1=-2, dim2=-1).add_(ctx.eps)
+    return mean, Sigma
+
+
+def _stale_scatter(history, decay):
+    """
+    Sum of the scatter matrices n_a C_a of the previous iterations in history (newest first), the one of
+    age a weighted by decay ** a, and their weighted number of samples. None for an empty history.
+    """
+    if not history:
+        return None
+    H, n_h, w = 0., 0., 1.
+    for C, n in history:
+        w *= decay
+        H = H + (w * n) * C
+        n_h += w * n
+    return H, n_h
+
+
+def _compensated_covariance(ctx, Sigma, n):
+    """
+    Covariance of the batch combined with ctx.stale, the scatter of the previous iterations. Every
+    iteration is centered on its own mean, so the drift of the activations between iterations does not
+    inflate the estimate. Returns the combined covariance (eps on the diagonal), its number of samples
+    and the covariance of the batch alone (without eps).
+    """
+    C = Sigma.clone()
+    C.diagonal(dim1=-2, dim2=-1).sub_(ctx.eps)
+    if ctx.stale is None:
+        return Sigma, n, C
+    H, n_h = ctx.stale
+    Sigma = (C * n + H) / (n + n_h)
+    Sigma.diagonal(dim1=-2, dim2=-1).add_(ctx.eps)
+    return Sigma, n + n_h, C
+
+
+def _rotated(ctx, wm):
+    """
+    wm followed by the constant rotation ctx.rot, if any, as a single matrix R wm
+    """
+    return wm if ctx.rot is None else ctx.rot.to(wm.dtype).matmul(wm)
+
+
+def _layout_forward(ctx, X, running_mean, running_wmat, nc, momentum, training):
+    ctx.channels_last = hasattr(torch, 'channels_last') and not X.is_contiguous() and \
+        X.is_contiguous(memory_format=torch.channels_last)
+    x = _layout_view(X, nc, ctx.channels_last)
+    saved = [X]
+    if training:
+        ctx.subset = _spatial_subset(ctx, x)
+        if ctx.info is not None and ctx.subset is not None:
+            ctx.info['subset'] = ctx.subset
+        x_s = _layout_subsample(x, ctx.subset)
+        S, s, ctx.n = _moments(ctx, x_s, x_s.numel() // X.size(1))
+        if ctx.moments is not None:
+            ctx.moments['pooled'] = (S, s, ctx.n)
+        mean, Sigma = _mean_covariance(ctx, S, s, ctx.n)
+        ctx.n_sigma = ctx.n
+        if ctx.history is not None:
+            ctx.stale = _stale_scatter(ctx.history, ctx.stale_decay)
+            Sigma, ctx.n_sigma, C = _compensated_covariance(ctx, Sigma, ctx.n)
+            ctx.history.appendleft((C, ctx.n))
+        whiten, _ = _whitening_backends[ctx.backend]
+        wm, state = whiten(ctx, Sigma)
+        saved.extend([mean, wm])
+        if not ctx.checkpoint:
+            saved.extend(state)
+        running_mean.copy_(momentum * mean + (1. - momentum) * running_mean)
+        running_wmat.copy_(momentum * wm + (1. - momentum) * running_wmat)
+    else:
+        mean = running_mean
+        wm = running_wmat
+    # wm is applied in the precision of X
+    A = _rotated(ctx, wm)
+    xn = _layout_apply(A.to(X.dtype), x, -A.matmul(mean).to(X.dtype))
+    ctx.save_for_backward(*saved)
+    return _layout_restore(xn, X.size(), ctx.channels_last)
+
+
+def _layout_backward(ctx, grad):
+    saved = ctx.saved_variables
+    X, mean, wm = saved[:3]
+    whiten, whiten_backward = _whitening_backends[ctx.backend]
+    x = _layout_view(X, mean.size(1), ctx.channels_last)
+    x_s = _layout_subsample(x, ctx.subset)
+    n = ctx.n
+    if ctx.checkpoint:
+        _, Sigma = _mean_covariance(ctx, *_moments(ctx, x_s, x_s.numel() // X.size(1)))
+        if ctx.history is not None:
+            Sigma, _, _ = _compensated_covariance(ctx, Sigma, n)
+        _, state = whiten(ctx, Sigma)
+    else:
+        state = saved[3:]
+    g_ = _layout_view(grad, mean.size(1), ctx.channels_last)
+    g_sum = _layout_sum(g_)
+    # sum_j g_j (x_j - mean)^T
+    g_wm = torch.baddbmm(_layout_gram(g_, x), g_sum, mean.transpose(1, 2), alpha=-1.)
+    if ctx.process_group is not None:
+        # the loss depends on wm and mean through the outputs of all processes
+        g_wm, g_sum = _all_reduce(ctx.process_group, g_wm, g_sum)
+    if ctx.rot is not None:
+        # the output is R wm (x - mean) with a constant R, the gradient of wm is R^T g_wm
+        g_wm = ctx.rot.transpose(-2, -1).to(g_wm.dtype).matmul(g_wm)
+    # Sigma counts the samples of the previous iterations as well, the mean only those of the batch
+    g_sigma = whiten_backward(ctx, g_wm, wm, state).mul_(2. / ctx.n_sigma)
+    wm_t = _rotated(ctx, wm).transpose(-2, -1)
+    # g_x = wm^T (g - mean(g)) + g_sigma (x - mean)
+    bias = torch.baddbmm(g_sigma.matmul(mean), wm_t, g_sum, alpha=1. / n).neg_()
+    if ctx.subset is None:
+        g_x = _layout_apply(wm_t.to(grad.dtype), g_, bias.to(grad.dtype), g_sigma.to(grad.dtype), x)
+    else:
+        # mean and Sigma only depend on the subsampled positions, g_x = wm^T g + [g_sigma (x - mean) - wm^T mean(g)]
+        # where the bracket is only added, in place, to the window of those positions
+        g_x = _layout_apply(wm_t.to(grad.dtype), g_, bias.new_zeros(bias.size(), dtype=grad.dtype))
+        _layout_apply_add_(_layout_subsample(g_x, ctx.subset), g_sigma.to(grad.dtype), x_s, bias.to(grad.dtype))
+    return _layout_restore(g_x, grad.size(), ctx.channels_last)
+
 
 class iterative_normalization_py(torch.autograd.Function):
+    # number of inputs of forward, backward returns as many gradients (the trailing None ones of the options
+    # left to their defaults are dropped by autograd)
+    num_inputs = 21
+
     @staticmethod
-    def forward(ctx, *args, **kwargs):
-        X, running_mean, running_wmat, nc, ctx.T, eps, momentum, training = args
-        # change NxCxHxW to (G x D) x(NxHxW), i.e., g*d*m
+    @_custom_fwd
+    def forward(ctx, X, running_mean, running_wmat, nc, T, eps, momentum, training, backend='newton', checkpoint=False,
+                workspace=None, tol=None, info=None, layout_aware=False, process_group=None, subsample=None,
+                subsample_mode='fixed', moments=None, history=None, stale_decay=1., rot=None):
+        ctx.T, ctx.eps, ctx.backend, ctx.checkpoint, ctx.workspace, ctx.tol, ctx.info = \
+            T, eps, backend, checkpoint, workspace, tol, info
+        ctx.subsample, ctx.subsample_mode, ctx.stale_decay, ctx.rot = subsample, subsample_mode, stale_decay, rot
+        ctx.num_inputs = iterative_normalization_py.num_inputs
         ctx.g = X.size(1) // nc
-        x = X.transpose(0, 1).contiguous().view(ctx.g, nc, -1)
+        # the statistics are only synchronized, pooled or combined with previous iterations in training,
+        # eval uses the running ones
+        ctx.process_group = process_group if training else None
+        ctx.moments = moments if training and X.dim() == 4 else None
+        ctx.pooled = ctx.moments.get('pooled') if ctx.moments is not None else None
+        ctx.history = history if training and X.dim() == 4 else None
+        # synchronized, subsampled, pooled and cross-iteration inputs take the layout-aware path, which needs the
+        # statistics as raw sums; reduced-precision inputs are whitened on either path with float32 statistics
+        ctx.layout_aware = (layout_aware or ctx.process_group is not None or
+                            ctx.subsample is not None or ctx.moments is not None or ctx.history is not None) and \
+            X.dim() == 4
+        if ctx.layout_aware:
+            return _layout_forward(ctx, X, running_mean, running_wmat, nc, momentum, training)
+        # change NxCxHxW to (G x D) x(NxHxW), i.e., g*d*m; the copy is made in the precision of the statistics
+        x = X.transpose(0, 1).contiguous().view(ctx.g, nc, -1).to(_stats_dtype(X))
         _, d, m = x.size()
         saved = []
         if training:
             # calculate centered activation by subtracted mini-batch mean
             mean = x.mean(-1, keepdim=True)
             xc = x - mean
-            saved.append(xc)
             # calculate covariance matrix
-            P = [None] * (ctx.T + 1)
-            P[0] = torch.eye(d).to(X).expand(ctx.g, d, d)
-            Sigma = torch.baddbmm(eps, P[0], 1. / m, xc, xc.transpose(1, 2))
-            # reciprocal of trace of Sigma: shape [g, 1, 1]
-            rTr = (Sigma * P[0]).sum((1, 2), keepdim=True).reciprocal_()
-            saved.append(rTr)
-            Sigma_N = Sigma * rTr
-            saved.append(Sigma_N)
-            for k in range(ctx.T):
-                P[k + 1] = torch.baddbmm(1.5, P[k], -0.5, torch.matrix_power(P[k], 3), Sigma_N)
-            saved.extend(P)
-            wm = P[ctx.T].mul_(rTr.sqrt())  # whiten matrix: the matrix inverse of Sigma, i.e., Sigma^{-1/2}
+            Sigma = _covariance(ctx, xc)
+            whiten, _ = _whitening_backends[ctx.backend]
+            wm, state = whiten(ctx, Sigma)
+            if ctx.checkpoint:
+                # only keep X, the mean and wm, xc and the backend state are rebuilt in backward
+                saved.extend([X, mean, wm])
+            else:
+                saved.extend([xc, wm])
+                saved.extend(state)
             running_mean.copy_(momentum * mean + (1. - momentum) * running_mean)
             running_wmat.copy_(momentum * wm + (1. - momentum) * running_wmat)
         else:
             xc = x - running_mean
-            wm = running_wmat
-        xn = wm.matmul(xc)
-        Xn = xn.view(X.size(1), X.size(0), *X.size()[2:]).transpose(0, 1).contiguous()
+            wm = running_wmat.to(x.dtype)
+        xn = _rotated(ctx, wm).matmul(xc)
+        Xn = xn.view(X.size(1), X.size(0), *X.size()[2:]).transpose(0, 1).contiguous().to(X.dtype)
         ctx.save_for_backward(*saved)
         return Xn
 
     @staticmethod
+    @_custom_bwd
     def backward(ctx, *grad_outputs):
         grad, = grad_outputs
+        if ctx.layout_aware:
+            return (_layout_backward(ctx, grad),) + (None,) * (ctx.num_inputs - 1)
         saved = ctx.saved_variables
-        xc = saved[0]  # centered input
-        rTr = saved[1]  # trace of Sigma
-        sn = saved[2].transpose(-2, -1)  # normalized Sigma
-        P = saved[3:]  # middle result matrix,
+        whiten, whiten_backward = _whitening_backends[ctx.backend]
+        if ctx.checkpoint:
+            X, mean, wm = saved
+            xc = X.transpose(0, 1).contiguous().view(ctx.g, mean.size(1), -1).to(mean.dtype) - mean
+            _, state = whiten(ctx, _covariance(ctx, xc))
+        else:
+            xc = saved[0]  # centered input
+            wm = saved[1]  # whitening matrix
+            state = saved[2:]  # intermediate results of the whitening backend
         g, d, m = xc.size()
 
-        g_ = grad.transpose(0, 1).contiguous().view_as(xc)
+        g_ = grad.transpose(0, 1).contiguous().view_as(xc).to(xc.dtype)
         g_wm = g_.matmul(xc.transpose(-2, -1))
-        g_P = g_wm * rTr.sqrt()
-        wm = P[ctx.T]
-        g_sn = 0
-        for k in range(ctx.T, 1, -1):
-            P[k - 1].transpose_(-2, -1)
-            P2 = P[k - 1].matmul(P[k - 1])
-            g_sn += P2.matmul(P[k - 1]).matmul(g_P)
-            g_tmp = g_P.matmul(sn)
-            g_P.baddbmm_(1.5, -0.5, g_tmp, P2)
-            g_P.baddbmm_(1, -0.5, P2, g_tmp)
-            g_P.baddbmm_(1, -0.5, P[k - 1].matmul(g_tmp), P[k - 1])
-        g_sn += g_P
-        # g_sn = g_sn * rTr.sqrt()
-        g_tr = ((-sn.matmul(g_sn) + g_wm.transpose(-2, -1).matmul(wm)) * P[0]).sum((1, 2), keepdim=True) * P[0]
-        g_sigma = (g_sn + g_sn.transpose(-2, -1) + 2. * g_tr) * (-0.5 / m * rTr)
-        # g_sigma = g_sigma + g_sigma.transpose(-2, -1)
-        g_x = torch.baddbmm(wm.matmul(g_ - g_.mean(-1, keepdim=True)), g_sigma, xc)
-        grad_input = g_x.view(grad.size(1), grad.size(0), *grad.size()[2:]).transpose(0, 1).contiguous()
-        return grad_input, None, None, None, None, None, None, None
+        if ctx.rot is not None:
+            # the output is R wm xc with a constant R, the gradient of wm is R^T g_wm
+            g_wm = ctx.rot.transpose(-2, -1).to(g_wm.dtype).matmul(g_wm)
+        g_sigma = whiten_backward(ctx, g_wm, wm, state)
+        g_x = torch.baddbmm(_rotated(ctx, wm).transpose(-2, -1).matmul(g_ - g_.mean(-1, keepdim=True)), g_sigma, xc,
+                            alpha=2. / m)
+        grad_input = g_x.view(grad.size(1), grad.size(0), *grad.size()[2:]).transpose(0, 1).contiguous().to(grad.dtype)
+        return (grad_input,) + (None,) * (ctx.num_inputs - 1)
+
+
+# backend chosen by the 'auto' mode, keyed by (C, batch, HW, num_channels, T)
+_auto_backend_cache = {}
+
+
+# backends `auto` chooses from, they all whiten with Sigma^{-1/2}
+_auto_backends = ('newton', 'eigh')
+
+
+def iterative_normalization(X, running_mean, running_wmat, nc, T, eps, momentum, training, backend='newton',
+                            checkpoint=False, workspace=None, tol=None, info=None, layout_aware=False,
+                            process_group=None, subsample=None, subsample_mode='fixed', moments=None, history=None,
+                            stale_decay=1., rot=None):
+    """
+    iterative_normalization_py.apply, with the options after training as keyword arguments
+    """
+    return iterative_normalization_py.apply(X, running_mean, running_wmat, nc, T, eps, momentum, training, backend,
+                                            checkpoint, workspace, tol, info, layout_aware, process_group, subsample,
+                                            subsample_mode, moments, history, stale_decay, rot)
+
+
+def select_whitening_backend(size, num_channels, T=5, eps=1e-5, repeats=3):
+    """
+    Return the fastest whitening backend for an input of shape `size`.
+
+    Only the backends computing the ZCA whitening matrix (newton and eigh) are candidates: cholesky whitens in
+    another basis, so switching to it with the input shape would mix bases in running_wm and break the rotation.
+    They are timed (forward + backward) on a random CPU tensor of that shape;
+    the winner is cached so that the benchmark only runs once per shape.
+    """
+    hw = 1
+    for s in size[2:]:
+        hw *= s
+    key = (size[1], size[0], hw, num_channels, T)
+    if key not in _auto_backend_cache:
+        g = size[1] // num_channels
+        X = torch.randn(*size)
+        running_mean = torch.zeros(g, num_channels, 1)
+        running_wm = torch.eye(num_channels).expand(g, num_channels, num_channels).clone()
+        timings = {}
+        with torch.enable_grad():
+            for backend in _auto_backends:
+                timings[backend] = float('inf')
+                for _ in range(repeats):
+                    X.grad = None
+                    X.requires_grad_()
+                    start = time.time()
+                    iterative_normalization(X, running_mean, running_wm, num_channels, T, eps, 0., True,
+                                            backend=backend).sum().backward()
+                    timings[backend] = min(timings[backend], time.time() - start)
+        _auto_backend_cache[key] = min(timings, key=timings.get)
+    return _auto_backend_cache[key]
+
+
+def _whitening_conv(X, mean, wm):
+    """
+    wm (X - mean) for fixed mean and wm, i.e. a grouped 1x1 convolution, differentiable with respect to X only
+    """
+    g, d, _ = wm.size()
+    weight = wm.reshape(g * d, d, 1, 1).to(X.dtype)
+    bias = -wm.matmul(mean).reshape(g * d).to(X.dtype)
+    return F.conv2d(X, weight, bias, groups=g)
 
 
 class IterNorm(torch.nn.Module):
     def __init__(self, num_features, num_groups=1, num_channels=None, T=5, dim=4, eps=1e-5, momentum=0.1, affine=True,
-                 *args, **kwargs):
+                 backend='newton', checkpoint=False, tol=None, layout_aware=False, subsample=None,
+                 subsample_mode='fixed', micro_batches=1, *args, **kwargs):
         super(IterNorm, self).__init__()
         # assert dim == 4, 'IterNorm is not support 2D'
+        assert backend == 'auto' or backend in _whitening_backends, 'Unknown whitening backend {}'.format(backend)
+        assert subsample_mode in ('fixed', 'random'), 'Unknown subsample mode {}'.format(subsample_mode)
         self.T = T
         self.eps = eps
         self.momentum = momentum
         self.num_features = num_features
         self.affine = affine
         self.dim = dim
+        self.backend = backend
+        # recompute the whitening intermediates in backward instead of storing them
+        self.checkpoint = checkpoint
+        # stop the Newton-Schulz iterations early once the residual is below tol (T is the upper bound)
+        self.tol = tol
+        # whiten NCHW / channels_last memory in place of the transposed (g, d, m) copies
+        self.layout_aware = layout_aware
+        # estimate the mean and covariance from this fraction of the spatial positions ('fixed' or 'random' ones),
+        # the whitening is still applied to all of them
+        self.subsample = subsample
+        self.subsample_mode = subsample_mode
+        # whiten each training batch with the moments pooled over the micro-batches of the accumulation window
+        # seen so far, the window restarts every micro_batches batches or at reset_moments()
+        self.micro_batches = micro_batches
+        # pooled moments of the current window, per device (DataParallel replicas share this dict)
+        self._pooled = {}
+        # scratch buffers of the whitening iterations, per (g, d, dtype, device)
+        self._workspace = {}
+        # statistics of the last training forward, e.g. the number of iterations taken
+        self.whitening_info = {}
         if num_channels is None:
             num_channels = (num_features - 1) // num_groups + 1
         num_groups = num_features // num_channels
@@ -114,7 +735,8 @@ class IterNorm(torch.nn.Module):
 
         self.register_buffer('running_mean', torch.zeros(num_groups, num_channels, 1))
         # running whiten matrix
-        self.register_buffer('running_wm', torch.eye(num_channels).expand(num_groups, num_channels, num_channels))
+        self.register_buffer('running_wm',
+                             torch.eye(num_channels).expand(num_groups, num_channels, num_channels).clone())
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -124,17 +746,50 @@ class IterNorm(torch.nn.Module):
             torch.nn.init.zeros_(self.bias)
 
     def forward(self, X: torch.Tensor):
-        X_hat = iterative_normalization_py.apply(X, self.running_mean, self.running_wm, self.num_channels, self.T,
-                                                 self.eps, self.momentum, self.training)
+        X, precision = _whitening_precision(X)
+        with precision:
+            X_hat = iterative_normalization(X, self.running_mean, self.running_wm, self.num_channels, self.T,
+                                            self.eps, self.momentum, self.training, backend=self._backend(X),
+                                            checkpoint=self.checkpoint, workspace=self._workspace, tol=self.tol,
+                                            info=self.whitening_info, layout_aware=self.layout_aware,
+                                            process_group=self._process_group(), subsample=self.subsample,
+                                            subsample_mode=self.subsample_mode, moments=self._pooled_moments(X))
         # affine
         if self.affine:
-            return X_hat * self.weight + self.bias
+            return X_hat * self.weight.to(X_hat.dtype) + self.bias.to(X_hat.dtype)
         else:
             return X_hat
 
+    def _backend(self, X):
+        if self.backend == 'auto' and self.training:
+            return select_whitening_backend(X.size(), self.num_channels, self.T, self.eps)
+        return self.backend
+
+    def _process_group(self):
+        # the statistics are those of the local batch
+        return None
+
+    def _pooled_moments(self, X):
+        if not self.training or self.micro_batches <= 1:
+            return None
+        pooled = self._pooled.setdefault(X.device, {'count': 0})
+        if pooled['count'] == self.micro_batches:
+            pooled.clear()
+            pooled['count'] = 0
+        pooled['count'] += 1
+        return pooled
+
+    def reset_moments(self):
+        """
+        Start a new accumulation window, e.g. after each optimizer step
+        """
+        self._pooled.clear()
+
     def extra_repr(self):
         return '{num_features}, num_channels={num_channels}, T={T}, eps={eps}, ' \
-               'momentum={momentum}, affine={affine}'.format(**self.__dict__)
+               'momentum={momentum}, affine={affine}, backend={backend}, checkpoint={checkpoint}, tol={tol}, ' \
+               'layout_aware={layout_aware}, subsample={subsample}, subsample_mode={subsample_mode}, ' \
+               'micro_batches={micro_batches}'.format(**self.__dict__)
 
 
 class IterNormRotation(torch.nn.Module):
@@ -150,10 +805,22 @@ class IterNormRotation(torch.nn.Module):
     by activation_mode.
 
     """
+    # step sizes of the Cayley transform evaluated by the line search, relative to the last one
+    CAYLEY_STEPS = [2. ** i for i in range(-16, 9)]
+
     def __init__(self, num_features, num_groups = 1, num_channels=None, T=10, dim=4, eps=1e-5, momentum=0.05, affine=False,
-                mode = -1, activation_mode='pool_max', *args, **kwargs):
+                mode = -1, activation_mode='pool_max', backend='newton', checkpoint=False,
+                tol=None, layout_aware=False, subsample=None, subsample_mode='fixed', whiten_every=1,
+                freeze_after=None, micro_batches=1, cross_iterations=0, stale_decay=1., rank=None,
+                rotation_optimizer='cayley', rotation_retraction='qr', rotation_lr=0.1, rotation_momentum=0.9,
+                concept_projection=False, *args, **kwargs):
         super(IterNormRotation, self).__init__()
         assert dim == 4, 'IterNormRotation does not support 2D'
+        assert backend == 'auto' or backend in _whitening_backends, 'Unknown whitening backend {}'.format(backend)
+        assert subsample_mode in ('fixed', 'random'), 'Unknown subsample mode {}'.format(subsample_mode)
+        assert rotation_optimizer in ('cayley', 'sgd', 'adam', 'procrustes'), 'Unknown rotation optimizer {}'.format(
+            rotation_optimizer)
+        assert rotation_retraction in _retractions, 'Unknown retraction {}'.format(rotation_retraction)
         self.T = T
         self.eps = eps
         self.momentum = momentum
@@ -162,15 +829,70 @@ class IterNormRotation(torch.nn.Module):
         self.dim = dim
         self.mode = mode
         self.activation_mode = activation_mode
+        self.backend = backend
+        # recompute the whitening intermediates in backward instead of storing them
+        self.checkpoint = checkpoint
+        # stop the Newton-Schulz iterations early once the residual is below tol (T is the upper bound)
+        self.tol = tol
+        # whiten NCHW / channels_last memory in place of the transposed (g, d, m) copies
+        self.layout_aware = layout_aware
+        # estimate the mean and covariance from this fraction of the spatial positions ('fixed' or 'random' ones),
+        # the whitening is still applied to all of them
+        self.subsample = subsample
+        self.subsample_mode = subsample_mode
+        # recompute the whitening matrix every whiten_every training steps only, the running one is used in between
+        self.whiten_every = whiten_every
+        # after freeze_after training steps, always whiten with the running statistics (a fixed affine transform)
+        self.freeze_after = freeze_after
+        # whiten each training batch with the moments pooled over the micro-batches of the accumulation window
+        # seen so far, the window restarts every micro_batches batches or at reset_moments()
+        self.micro_batches = micro_batches
+        # pooled moments of the current window, per device (DataParallel replicas share this dict)
+        self._pooled = {}
+        # combine the covariance of each training batch with the ones of the previous cross_iterations
+        # iterations, each centered on its own mean, the one of age a weighted by stale_decay ** a
+        self.cross_iterations = cross_iterations
+        self.stale_decay = stale_decay
+        # ring buffers of (covariance, number of samples) of the previous iterations, per device
+        self._history = {}
+        # training steps taken, per device (DataParallel replicas share this dict)
+        self._whitening_steps = {}
+        # scratch buffers of the whitening iterations, per (g, d, dtype, device)
+        self._workspace = {}
+        # statistics of the last training forward, e.g. the number of iterations taken
+        self.whitening_info = {}
+        # per-sample concept labels of the next forward (-1 for none), all their columns of sum_G are updated at once
+        self.concept_labels = None
+        # pooled moments of the calibration forwards so far, per (whitened part, device), None when not calibrating
+        self._calibration = None
+        # 'cayley': Cayley transform with a line search, 'sgd' / 'adam': Riemannian gradient step with momentum /
+        # Adam of learning rate rotation_lr (rotation_momentum is the momentum, or beta1 of Adam), followed by the
+        # 'qr' or 'polar' retraction onto the rotations, 'procrustes': closed-form minimizer of <G, R>
+        self.rotation_optimizer = rotation_optimizer
+        self.rotation_retraction = rotation_retraction
+        self.rotation_lr = rotation_lr
+        self.rotation_momentum = rotation_momentum
+        # build the masks of the concept updates from the concept channel only and take them on the rotated output
+        # (the gradient of the concept activation with respect to its row of R), instead of masking each entry
+        # of the row by its own rotated channel on a second, unrotated copy of the activation
+        self.concept_projection = concept_projection
 
-        assert num_groups == 1, 'Please keep num_groups = 1. Current version does not support group whitening.'
+        # With a rank r, only the coordinates of the activation in a learned r-dimensional subspace, the top-r
+        # eigenvectors of the running covariance, are whitened and rotated (so the concept axes are among them);
+        # the residual is standardized channel by channel on the last C - r channels: O(C r^2) instead of O(C^3).
+        # The concept axes stay decorrelated from the residual as long as the subspace is an eigenspace.
+        assert rank is None or 0 < rank < num_features, 'rank={} for {} features'.format(rank, num_features)
+        self.rank = rank
+        num_whitened = num_features if rank is None else rank
+        # With several groups the whitening is block-diagonal and concept j is aligned with channel j, i.e. axis
+        # j % num_channels of group j // num_channels: only the groups that contain concept axes are rotated.
         if num_channels is None:
-            num_channels = (num_features - 1) // num_groups + 1
-        num_groups = num_features // num_channels
-        while num_features % num_channels != 0:
+            num_channels = (num_whitened - 1) // num_groups + 1
+        num_groups = num_whitened // num_channels
+        while num_whitened % num_channels != 0:
             num_channels //= 2
-            num_groups = num_features // num_channels
-        assert num_groups > 0 and num_features % num_groups == 0, "num features={}, num groups={}".format(num_features,
+            num_groups = num_whitened // num_channels
+        assert num_groups > 0 and num_whitened % num_groups == 0, "num features={}, num groups={}".format(num_whitened,
             num_groups)
 
         self.num_groups = num_groups
@@ -184,20 +906,39 @@ class IterNormRotation(torch.nn.Module):
         #   self.register_parameter('weight', None)
         #   self.register_parameter('bias', None)
 
-        #pooling and unpooling used in gradient computation
+        #pooling used in gradient computation (the unpooling is only kept for the models saved with it)
         self.maxpool = torch.nn.MaxPool2d(kernel_size=3, stride=3, return_indices=True)
         self.maxunpool = torch.nn.MaxUnpool2d(kernel_size=3, stride=3)
 
         # running mean
         self.register_buffer('running_mean', torch.zeros(num_groups, num_channels, 1))
         # running whiten matrix
-        self.register_buffer('running_wm', torch.eye(num_channels).expand(num_groups, num_channels, num_channels))
+        self.register_buffer('running_wm',
+                             torch.eye(num_channels).expand(num_groups, num_channels, num_channels).clone())
         # running rotation matrix
-        self.register_buffer('running_rot', torch.eye(num_channels).expand(num_groups, num_channels, num_channels))
+        self.register_buffer('running_rot',
+                             torch.eye(num_channels).expand(num_groups, num_channels, num_channels).clone())
         # sum Gradient, need to take average later
         self.register_buffer('sum_G', torch.zeros(num_groups, num_channels, num_channels))
         # counter, number of gradient for each concept
-        self.register_buffer("counter", torch.ones(num_channels)*0.001)
+        self.register_buffer("counter", torch.ones(num_whitened)*0.001)
+        if rank is not None:
+            # orthonormal basis [C, r] of the whitened subspace, and the running estimate of Sigma times it, from
+            # which the basis is refreshed by one step of block power (subspace) iteration at every training step
+            self.register_buffer('running_subspace', torch.eye(num_features, rank))
+            self.register_buffer('running_subspace_cov', torch.eye(num_features, rank))
+            # running mean and 1/std of the standardized residual channels, as groups of a single channel
+            self.register_buffer('running_tail_mean', torch.zeros(num_features - rank, 1, 1))
+            self.register_buffer('running_tail_wm', torch.ones(num_features - rank, 1, 1))
+        # step size of the last Cayley transform, the line search of the next one starts from it
+        self.register_buffer('cayley_tau', torch.tensor(1000.), persistent=False)
+        # state of the Riemannian optimizers, per group
+        if rotation_optimizer == 'sgd':
+            self.register_buffer('rot_momentum', torch.zeros(num_groups, num_channels, num_channels))
+        elif rotation_optimizer == 'adam':
+            self.register_buffer('rot_exp_avg', torch.zeros(num_groups, num_channels, num_channels))
+            self.register_buffer('rot_exp_avg_sq', torch.zeros(num_groups, num_channels, num_channels))
+            self.register_buffer('rot_step', torch.zeros(num_groups))
 
         self.reset_parameters()
 
@@ -210,55 +951,55 @@ class IterNormRotation(torch.nn.Module):
         """
         Update the rotation matrix R using the accumulated gradient G.
         The update uses Cayley transform to make sure R is always orthonormal.
+        Only the groups that contain concept axes, i.e. with a non-zero G, are updated, in the 2k-dimensional
+        space spanned by the k rows of G of the concept axes.
+
+        The line search evaluates all the step sizes of CAYLEY_STEPS, relative to the last one, in one batched
+        solve and keeps the largest that satisfies the Armijo and curvature conditions (the one that decreases
+        the objective most if none does) without leaving the device. Returns a dict with the number of steps and
+        of candidate step sizes evaluated, the final step size, the objective, whether the conditions were
+        satisfied at every step (tensors, to not synchronize) and the time spent in seconds (float() of it, which on
+        GPU waits for the update and reads its CUDA events).
+
+        With rotation_optimizer 'sgd' or 'adam', R takes instead one Riemannian gradient step of rotation_lr, with
+        momentum or Adam (whose state is kept in buffers), and is retracted with QR or polar decomposition.
+        With 'procrustes', R is replaced by the solution of procrustes_rotation().
         """
-        size_R = self.running_rot.size()
-        with torch.no_grad():
-            G = self.sum_G/self.counter.reshape(-1,1)
-            R = self.running_rot.clone()
-            for i in range(2):
-                tau = 1000 # learning rate in Cayley transform
-                alpha = 0
-                beta = 100000000
-                c1 = 1e-4
-                c2 = 0.9
-                
-                A = torch.einsum('gin,gjn->gij', G, R) - torch.einsum('gin,gjn->gij', R, G) # GR^T - RG^T
-                I = torch.eye(size_R[2]).expand(*size_R).cuda()
-                dF_0 = -0.5 * (A ** 2).sum()
-                # binary search for appropriate learning rate
-                cnt = 0
-                while True:
-                    Q = torch.bmm((I + 0.5 * tau * A).inverse(), I - 0.5 * tau * A)
-                    Y_tau = torch.bmm(Q, R)
-                    F_X = (G[:,:,:] * R[:,:,:]).sum()
-                    F_Y_tau = (G[:,:,:] * Y_tau[:,:,:]).sum()
-                    dF_tau = -torch.bmm(torch.einsum('gni,gnj->gij', G, (I + 0.5 * tau * A).inverse()), torch.bmm(A,0.5*(R+Y_tau)))[0,:,:].trace()
-                    if F_Y_tau > F_X + c1*tau*dF_0 + 1e-18:
-                        beta = tau
-                        tau = (beta+alpha)/2
-                    elif dF_tau  + 1e-18 < c2*dF_0:
-                        alpha = tau
-                        tau = (beta+alpha)/2
-                    else:
-                        break
-                    cnt += 1
-                    if cnt > 500:
-                        print("--------------------update fail------------------------")
-                        print(F_Y_tau, F_X + c1*tau*dF_0)
-                        print(dF_tau, c2*dF_0)
-                        print("-------------------------------------------------------")
-                        break
-                print(tau, F_Y_tau)
-                Q = torch.bmm((I + 0.5 * tau * A).inverse(), I - 0.5 * tau * A)
-                R = torch.bmm(Q, R)
-            
-            self.running_rot = R
-            self.counter = (torch.ones(size_R[-1]) * 0.001).cuda()
+        return update_rotation_matrices([self])[0]
 
+    def procrustes_rotation(self):
+        """
+        Set R to the rotation that best aligns the concept axes with the accumulated concept gradients G, e.g.
+        as a warm start from the identity: the minimizer of <G, R> (orthogonal Procrustes problem), from a
+        single SVD of the rows of G of the concept axes. Returns the same stats as update_rotation_matrix
+        """
+        return _procrustes_update([self])[0]
 
     def forward(self, X: torch.Tensor):
-        X_hat = iterative_normalization_py.apply(X, self.running_mean, self.running_wm, self.num_channels, self.T,
-                                                 self.eps, self.momentum, self.training)
+        X, precision = _whitening_precision(X)
+        recompute = self._recompute_whitening(X)
+        # the masked concept updates need the activation before the rotation, otherwise the rotation is composed
+        # into the whitening matrix, (R wm) (x - mean), a single channel mixing
+        concept_update = self.mode>=0 or self.concept_labels is not None
+        if concept_update and self.rank is not None:
+            # only the coordinates in the subspace are rotated, the concept axes must be among them
+            assert self.mode < self.rank, 'concept {} outside the rank {} subspace'.format(self.mode, self.rank)
+            assert self.concept_labels is None or int(self.concept_labels.max()) < self.rank, \
+                'concept labels outside the rank {} subspace'.format(self.rank)
+        masked_update = concept_update and not self.concept_projection
+        rot = None if masked_update else self.running_rot
+        with precision:
+            if self.rank is None:
+                X_hat = self._whiten(X, recompute, rot)
+            else:
+                U = self.running_subspace
+                # coordinates in the subspace U^T x, and the residual x - U U^T x on the last C - r channels
+                X_sub = F.conv2d(X, U.t().reshape(self.rank, self.num_features, 1, 1).to(X.dtype))
+                X_res = X[:, self.rank:] - F.conv2d(X_sub, U[self.rank:].reshape(-1, self.rank, 1, 1).to(X.dtype))
+                X_hat = self._whiten(X_sub, recompute, rot)
+                X_tail = self._standardize(X_res, recompute)
+                if recompute and self._calibration is None:
+                    self._update_subspace(X, X_sub)
         # print(X_hat.shape, self.running_rot.shape)
         # nchw
         size_X = X_hat.size()
@@ -269,32 +1010,21 @@ class IterNormRotation(torch.nn.Module):
         # the gradient is accumulated with momentum to stablize the training
         with torch.no_grad():
             # When 0<=mode, the jth column of gradient matrix is accumulated
-            if self.mode>=0:
-                if self.activation_mode=='mean':
-                    self.sum_G[:,self.mode,:] = self.momentum * -X_hat.mean((0,3,4)) + (1. - self.momentum) * self.sum_G[:,self.mode,:]
-                    self.counter[self.mode] += 1
-                elif self.activation_mode=='max':
-                    X_test = torch.einsum('bgchw,gdc->bgdhw', X_hat, self.running_rot)
-                    max_values = torch.max(torch.max(X_test, 3, keepdim=True)[0], 4, keepdim=True)[0]
-                    max_bool = max_values==X_test
-                    grad = -((X_hat * max_bool.to(X_hat)).sum((3,4))/max_bool.to(X_hat).sum((3,4))).mean((0,))
-                    self.sum_G[:,self.mode,:] = self.momentum * grad + (1. - self.momentum) * self.sum_G[:,self.mode,:]
-                    self.counter[self.mode] += 1
-                elif self.activation_mode=='pos_mean':
-                    X_test = torch.einsum('bgchw,gdc->bgdhw', X_hat, self.running_rot)
-                    pos_bool = X_test > 0
-                    grad = -((X_hat * pos_bool.to(X_hat)).sum((3,4))/(pos_bool.to(X_hat).sum((3,4))+0.0001)).mean((0,))
-                    self.sum_G[:,self.mode,:] = self.momentum * grad + (1. - self.momentum) * self.sum_G[:,self.mode,:]
-                    self.counter[self.mode] += 1
-                elif self.activation_mode=='pool_max':
-                    X_test = torch.einsum('bgchw,gdc->bgdhw', X_hat, self.running_rot)
-                    X_test_nchw = X_test.view(size_X)
-                    maxpool_value, maxpool_indices = self.maxpool(X_test_nchw)
-                    X_test_unpool = self.maxunpool(maxpool_value, maxpool_indices, output_size = size_X).view(size_X[0], size_R[0], size_R[2], *size_X[2:])
-                    maxpool_bool = X_test == X_test_unpool
-                    grad = -((X_hat * maxpool_bool.to(X_hat)).sum((3,4))/(maxpool_bool.to(X_hat).sum((3,4)))).mean((0,))
-                    self.sum_G[:,self.mode,:] = self.momentum * grad + (1. - self.momentum) * self.sum_G[:,self.mode,:]
-                    self.counter[self.mode] += 1
+            # With concept_labels, the column of the concept of each sample (-1 for none) is accumulated
+            # We set mode = -1 when we don't need to update G. For example, when we train for main objective
+            if concept_update:
+                if self.mode>=0:
+                    concepts = torch.full((size_X[0],), self.mode, dtype=torch.long, device=X_hat.device)
+                else:
+                    concepts = self.concept_labels.clamp(min=0)
+                if self.concept_projection:
+                    grad = self._concept_gradients(X_hat, concepts)
+                else:
+                    grad = self._masked_concept_gradients(X_hat, concepts)
+                if self.mode>=0:
+                    self._accumulate_concept_gradient(grad.mean((0,)))
+                else:
+                    self._accumulate_labelled_gradients(grad, self.concept_labels)
             # # When mode > k, this is not included in the paper
             # elif self.mode>=0 and self.mode>=self.k:
             #     X_dot = torch.einsum('ngchw,gdc->ngdhw', X_hat, self.running_rot)
@@ -304,18 +1034,738 @@ class IterNormRotation(torch.nn.Module):
             #     X_G[:,:self.k,:] = 0.0
             #     self.sum_G[:,:,:] += -X_G/size_X[0]
             #     self.counter[self.k:] += 1
-        
-        # We set mode = -1 when we don't need to update G. For example, when we train for main objective
-        X_hat = torch.einsum('bgchw,gdc->bgdhw', X_hat, self.running_rot)
-        X_hat = X_hat.view(*size_X)
+
+        if masked_update:
+            X_hat = torch.einsum('bgchw,gdc->bgdhw', X_hat, self.running_rot.to(X_hat.dtype))
+        X_hat = X_hat.reshape(*size_X)
+        if self.rank is not None:
+            X_hat = torch.cat([X_hat, X_tail], 1)
         if self.affine:
-            return X_hat * self.weight + self.bias
+            return X_hat * self.weight.to(X_hat.dtype) + self.bias.to(X_hat.dtype)
         else:
             return X_hat
 
+    def fused_transform(self):
+        """
+        Weight [C, C] and bias [C] of the affine map the layer applies in eval mode,
+        x -> weight * (R W (x - mean)) + bias, with the running mean, whitening and rotation matrices
+        (with a rank, R W (U^T x - mean) on the first r channels and the standardized residual on the others)
+        """
+        with torch.no_grad():
+            g, d, _ = self.running_wm.size()
+            M = self.running_rot.matmul(self.running_wm)
+            b = -M.matmul(self.running_mean).view(-1)
+            A = M.new_zeros(g * d, g * d)
+            for i in range(g):
+                A[i * d:(i + 1) * d, i * d:(i + 1) * d] = M[i]
+            if self.rank is not None:
+                U = self.running_subspace
+                residual = -U[self.rank:].matmul(U.t())
+                residual[:, self.rank:] += torch.eye(self.num_features - self.rank).to(residual)
+                A = torch.cat([A.matmul(U.t()), self.running_tail_wm.view(-1, 1) * residual])
+                b = torch.cat([b, -(self.running_tail_wm * self.running_tail_mean).view(-1)])
+            if self.affine:
+                A.mul_(self.weight.view(-1, 1))
+                b = b * self.weight.view(-1) + self.bias.view(-1)
+        return A, b
+
+    def fuse(self, conv=None):
+        """
+        Fold the eval-mode transform of the layer into a 1x1 convolution, or into conv, the (ungrouped)
+        convolution right before it. The result only reproduces the layer for inference: concept gradients
+        are no longer accumulated and the whitening statistics are no longer updated.
+        """
+        A, b = self.fused_transform()
+        if conv is None:
+            fused = torch.nn.Conv2d(self.num_features, self.num_features, 1)
+            weight = A.view(*A.size(), 1, 1)
+        else:
+            assert conv.groups == 1, 'Cannot fold CW into a grouped convolution'
+            fused = copy.deepcopy(conv)
+            weight = torch.einsum('oc,cikl->oikl', A, conv.weight.detach())
+            if conv.bias is not None:
+                b = b + A.matmul(conv.bias.detach())
+        fused.weight = Parameter(weight.clone())
+        fused.bias = Parameter(b.clone())
+        return fused.to(self.running_wm.device)
+
+    def _masked_concept_gradients(self, X_hat, concepts):
+        """
+        Per-sample gradients [b, d] of the concept of each sample, concepts [b], from the activations before the
+        rotation X_hat [b, g, c, h, w]: entry c of the row of a concept is masked by the maxima (or positives) of
+        rotated channel c
+        """
+        size_X = (X_hat.size(0), -1, X_hat.size(3), X_hat.size(4))
+        # per-sample gradients [b, g, c]
+        if self.activation_mode=='mean':
+            grad = -X_hat.mean((3,4))
+        elif self.activation_mode=='max':
+            X_test = torch.einsum('bgchw,gdc->bgdhw', X_hat, self.running_rot.to(X_hat.dtype))
+            # X_hat at the position of the maximum of each rotated channel
+            max_indices = X_test.flatten(3).argmax(3, keepdim=True)
+            grad = -X_hat.flatten(3).gather(3, max_indices).squeeze(3)
+        elif self.activation_mode=='pos_mean':
+            X_test = torch.einsum('bgchw,gdc->bgdhw', X_hat, self.running_rot.to(X_hat.dtype))
+            pos_bool = X_test > 0
+            grad = -((X_hat * pos_bool.to(X_hat)).sum((3,4))/(pos_bool.to(X_hat).sum((3,4))+0.0001))
+        elif self.activation_mode=='pool_max':
+            X_test = torch.einsum('bgchw,gdc->bgdhw', X_hat, self.running_rot.to(X_hat.dtype))
+            _, maxpool_indices = self.maxpool(X_test.reshape(size_X))
+            # mean of X_hat at the maxima of the (disjoint) pooling windows of each rotated channel
+            grad = -X_hat.reshape(size_X).flatten(2).gather(2, maxpool_indices.flatten(2)).mean(2)
+            grad = grad.view(X_hat.size(0), X_hat.size(1), X_hat.size(2))
+        # the gradient of each sample in the group of its concept
+        return grad[torch.arange(grad.size(0), device=grad.device), concepts // self.num_channels]
+
+    def _concept_gradients(self, X_hat, concepts):
+        """
+        Per-sample gradients [b, d] of the activation of the concept of each sample, concepts [b], with respect
+        to its row of the rotation matrix, from the rotated activations X_hat [b, g, d, h, w] (concept_projection)
+
+        The activation of a concept only depends on its own rotated channel, which X_hat already holds: its
+        mask is built from that channel, the masked means are taken over the rotated activations and rotated
+        back with R^T, instead of rotating the whole activation a second time.
+        """
+        b, d = X_hat.size(0), X_hat.size(2)
+        samples = torch.arange(b, device=X_hat.device)
+        groups = concepts // self.num_channels
+        # the group of the concept of each sample [b, d, h, w], and its channel [b, h, w]
+        x = X_hat[:, 0] if self.num_groups == 1 else X_hat[samples, groups]
+        x_concept = x[samples, concepts % self.num_channels]
+        if self.activation_mode=='mean':
+            v = x.mean((2,3))
+        elif self.activation_mode=='max':
+            max_indices = x_concept.flatten(1).argmax(1).view(b, 1, 1)
+            v = x.flatten(2).gather(2, max_indices.expand(-1, d, -1)).squeeze(2)
+        elif self.activation_mode=='pos_mean':
+            pos = (x_concept > 0).to(x)
+            v = torch.einsum('bdhw,bhw->bd', x, pos) / (pos.sum((1,2)) + 0.0001).unsqueeze(1)
+        elif self.activation_mode=='pool_max':
+            # mean over the (disjoint) pooling windows of the activations at the maxima of the concept channel
+            _, maxpool_indices = self.maxpool(x_concept.unsqueeze(1))
+            v = x.flatten(2).gather(2, maxpool_indices.flatten(2).expand(-1, d, -1)).mean(2)
+        # the activations before the rotation are R^T X_hat
+        return -torch.einsum('bd,bdc->bc', v, self.running_rot.to(v.dtype)[groups])
+
+    def _accumulate_labelled_gradients(self, grad, labels):
+        """
+        Accumulate the per-sample gradients grad [b, d] of a mixed concept batch: the mean over the samples
+        of each concept in labels [b] (-1 for none) goes into the row of sum_G of its axis, in one scatter
+        """
+        d = self.num_channels
+        valid = (labels >= 0).to(self.sum_G.dtype)
+        labels = labels.clamp(min=0)
+        grad = grad.to(self.sum_G.dtype)
+        sums = self.sum_G.new_zeros(self.sum_G.size(0) * d, d).index_add_(0, labels, grad * valid.unsqueeze(1))
+        counts = self.sum_G.new_zeros(self.sum_G.size(0) * d).index_add_(0, labels, valid)
+        self._update_concept_rows(sums, counts)
+
+    def _update_concept_rows(self, sums, counts):
+        # rows of sum_G, in concept order, of the concepts with samples get their mean gradient with momentum
+        present = (counts > 0).unsqueeze(1)
+        mean = sums / counts.clamp(min=1).unsqueeze(1)
+        G = self.sum_G.view(-1, self.num_channels)
+        G.copy_(torch.where(present, self.momentum * mean + (1. - self.momentum) * G, G))
+        self.counter += present.view(-1).to(self.counter.dtype)
+
+    def _accumulate_concept_gradient(self, grad):
+        """
+        Accumulate grad [d], the gradient of the activation of concept self.mode, with momentum in
+        the row of sum_G of its axis
+        """
+        group, axis = divmod(self.mode, self.num_channels)
+        self.sum_G[group, axis, :] = self.momentum * grad + (1. - self.momentum) * self.sum_G[group, axis, :]
+        self.counter[self.mode] += 1
+
+    def _backend(self, X):
+        if self.backend == 'auto' and (self.training or self._calibration is not None):
+            return select_whitening_backend(X.size(), self.num_channels, self.T, self.eps)
+        return self.backend
+
+    def _process_group(self):
+        # the statistics are those of the local batch
+        return None
+
+    def start_calibration(self):
+        """
+        Calibrate the running mean and whitening matrix on the next forwards (in eval mode, without gradients),
+        e.g. right after replacing a pretrained BatchNorm: each of them computes the mean and covariance pooled
+        over all the calibration batches so far, from their exact raw moments, and sets running_mean and
+        running_wm (momentum 1) to them and the whitening matrix of that covariance. Ends with stop_calibration()
+        """
+        self._calibration = {}
+
+    def stop_calibration(self):
+        self._calibration = None
+
+    def _calibration_moments(self, X, part):
+        if self._calibration is None:
+            return None
+        return self._calibration.setdefault((part, X.device), {})
+
+    def _pooled_moments(self, X):
+        if not self.training or self.micro_batches <= 1:
+            return None
+        pooled = self._pooled.setdefault(X.device, {'count': 0})
+        if pooled['count'] == self.micro_batches:
+            pooled.clear()
+            pooled['count'] = 0
+        pooled['count'] += 1
+        return pooled
+
+    def reset_moments(self):
+        """
+        Start a new accumulation window, e.g. after each optimizer step
+        """
+        self._pooled.clear()
+
+    def _stale_history(self, X):
+        if not self.training or self.cross_iterations <= 0:
+            return None
+        if X.device not in self._history:
+            self._history[X.device] = collections.deque(maxlen=self.cross_iterations)
+        return self._history[X.device]
+
+    def _recompute_whitening(self, X):
+        # whether this forward computes batch statistics, according to whiten_every and freeze_after
+        if not self.training:
+            return False
+        steps = self._whitening_steps.get(X.device, 0)
+        self._whitening_steps[X.device] = steps + 1
+        frozen = self.freeze_after is not None and steps >= self.freeze_after
+        return not frozen and steps % self.whiten_every == 0
+
+    def _whiten(self, X, recompute, rot=None):
+        if self.training and not recompute:
+            wm = self.running_wm if rot is None else rot.matmul(self.running_wm)
+            return _whitening_conv(X, self.running_mean, wm)
+        calibration = self._calibration_moments(X, 'whiten')
+        if calibration is not None:
+            # like a training forward on all the positions, with the moments pooled over the calibration batches
+            return iterative_normalization(X, self.running_mean, self.running_wm, self.num_channels, self.T, self.eps,
+                                           1., True, backend=self._backend(X), workspace=self._workspace,
+                                           tol=self.tol, layout_aware=self.layout_aware,
+                                           process_group=self._process_group(), moments=calibration, rot=rot)
+        return iterative_normalization(X, self.running_mean, self.running_wm, self.num_channels, self.T, self.eps,
+                                       self.momentum, self.training, backend=self._backend(X),
+                                       checkpoint=self.checkpoint, workspace=self._workspace, tol=self.tol,
+                                       info=self.whitening_info, layout_aware=self.layout_aware,
+                                       process_group=self._process_group(), subsample=self.subsample,
+                                       subsample_mode=self.subsample_mode, moments=self._pooled_moments(X),
+                                       history=self._stale_history(X), stale_decay=self.stale_decay, rot=rot)
+
+    def _update_subspace(self, X, X_sub):
+        """
+        One step of block power iteration on the running covariance: running_subspace_cov follows Sigma U with
+        momentum, from the cross-covariance of the batch X and its coordinates X_sub = U^T x, and U becomes its
+        orthonormalization, rotated to the basis closest to the previous U so that the whitened coordinates
+        (and the concept axes in them) do not change when the subspace does not
+        """
+        with torch.no_grad():
+            N, C = X.size()[:2]
+            dtype = _stats_dtype(X)
+            x = X.reshape(N, C, -1).to(dtype)
+            x_sub = X_sub.reshape(N, self.rank, -1).to(dtype)
+            m = x.size(0) * x.size(2)
+            # Sigma U = E[x (U^T x)^T] - mean (U^T mean)^T, in O(C r) per position
+            SU = torch.bmm(x, x_sub.transpose(1, 2)).sum(0) / m
+            SU -= x.mean((0, 2)).unsqueeze(1) * x_sub.mean((0, 2)).unsqueeze(0)
+            group = self._process_group()
+            if group is not None:
+                # every process keeps the same subspace
+                dist.all_reduce(SU, group=group)
+                SU /= dist.get_world_size(group)
+            if self._whitening_steps.get(X.device, 0) <= 1:
+                # start the iteration from the first batch rather than from the initial basis
+                self.running_subspace_cov.copy_(SU)
+            else:
+                self.running_subspace_cov.mul_(1. - self.momentum).add_(SU, alpha=self.momentum)
+            Q = _qr_retraction(self.running_subspace_cov.unsqueeze(0))[0]
+            # a new tensor, the forward may still need the previous basis in backward
+            self.running_subspace = Q.matmul(_polar_retraction(Q.t().matmul(self.running_subspace).unsqueeze(0))[0])
+
+    def _standardize(self, X, recompute):
+        # residual channels: whitening of groups of one channel, where one Newton step is exact
+        if self.training and not recompute:
+            return _whitening_conv(X, self.running_tail_mean, self.running_tail_wm)
+        calibration = self._calibration_moments(X, 'standardize')
+        return iterative_normalization(X, self.running_tail_mean, self.running_tail_wm, 1, 1, self.eps,
+                                       self.momentum if calibration is None else 1.,
+                                       self.training or calibration is not None, workspace=self._workspace,
+                                       layout_aware=self.layout_aware, process_group=self._process_group(),
+                                       subsample=self.subsample if calibration is None else None,
+                                       subsample_mode=self.subsample_mode, moments=calibration)
+
     def extra_repr(self):
         return '{num_features}, num_channels={num_channels}, T={T}, eps={eps}, ' \
-               'momentum={momentum}, affine={affine}'.format(**self.__dict__)
+               'momentum={momentum}, affine={affine}, backend={backend}, checkpoint={checkpoint}, tol={tol}, ' \
+               'layout_aware={layout_aware}, subsample={subsample}, subsample_mode={subsample_mode}, ' \
+               'whiten_every={whiten_every}, freeze_after={freeze_after}, micro_batches={micro_batches}, ' \
+               'cross_iterations={cross_iterations}, stale_decay={stale_decay}, ' \
+               'rank={rank}, ' \
+               'rotation_optimizer={rotation_optimizer}, rotation_retraction={rotation_retraction}, ' \
+               'rotation_lr={rotation_lr}, rotation_momentum={rotation_momentum}, ' \
+               'concept_projection={concept_projection}'.format(**self.__dict__)
+
+
+class _UpdateTimer(object):
+    """
+    Time spent by a rotation update on its device, in seconds once converted with float(). On GPU it is
+    measured with CUDA events and only read (which waits for the update) at the conversion; on CPU it is
+    the host time.
+    """
+
+    def __init__(self, device):
+        self.cuda = device.type == 'cuda'
+        if self.cuda:
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.end_event = torch.cuda.Event(enable_timing=True)
+            self.start_event.record()
+        else:
+            self.start = time.time()
+
+    def stop(self):
+        if self.cuda:
+            self.end_event.record()
+        else:
+            self.elapsed = time.time() - self.start
+        return self
+
+    def __float__(self):
+        if self.cuda:
+            self.end_event.synchronize()
+            return self.start_event.elapsed_time(self.end_event) / 1000.
+        return self.elapsed
+
+    def __repr__(self):
+        return '{:.6f}'.format(float(self))
+
+
+def _cayley_update(layers):
+    """
+    Cayley update of the rotation matrices of layers, whose rotations have the same size and device,
+    in one batched solve (see IterNormRotation.update_rotation_matrix). Returns the stats of each layer
+    """
+    timer = _UpdateTimer(layers[0].running_rot.device)
+    with torch.no_grad():
+        G, R, owner, groups = [], [], [], []
+        for i, layer in enumerate(layers):
+            groups.append(layer.sum_G.abs().sum((1, 2)).nonzero().view(-1))
+            G.append((layer.sum_G/layer.counter.reshape(*layer.sum_G.size()[:2], 1))[groups[i]])
+            R.append(layer.running_rot[groups[i]])
+            owner.append(torch.full((groups[i].numel(),), i, dtype=torch.long, device=layer.sum_G.device))
+        # the updated groups of all the layers [N, C, C], and the layer of each one [N]
+        G, R, owner = torch.cat(G), torch.cat(R), torch.cat(owner)
+        device = R.device
+        N, L = R.size(0), len(layers)
+        active = [g.numel() > 0 for g in groups]
+        layer_range = torch.arange(L, device=device)
+
+        def per_layer(x):
+            # sums of x [..., N, *] over the groups of each layer, [..., L]
+            x = x.reshape(*x.size()[:-3], N, -1).sum(-1)
+            return x.new_zeros(*x.size()[:-1], L).index_add_(x.dim() - 1, owner, x)
+
+        # G only has k non-zero rows, those of the concept axes: A = GR^T - RG^T = U V^T has rank 2k, with
+        # U = [P^T, -W^T], V = [W^T, P^T], W = G_k R^T and P [k, C] selecting the k rows. By Woodbury,
+        # (I + tau/2 A)^-1 = I - tau/2 U M^-1 V^T, M = I + tau/2 V^T U, so that the Cayley transform
+        # Y_tau = (I + tau/2 A)^-1 (I - tau/2 A) R = R - tau U M^-1 V^T R and the line search only take
+        # [2k, 2k] inverses and [k, C] / [2k, C] products, instead of [C, C] inverses and products.
+        rows = G.abs().sum((0, 2)).nonzero().view(-1)
+        G = G[:, rows]
+        P = torch.eye(R.size(2), device=device)[rows].expand_as(G)
+        I = torch.eye(2 * rows.numel(), device=device)
+        c1 = 1e-4
+        c2 = 0.9
+        tau = torch.stack([layer.cayley_tau for layer in layers])
+        objective, satisfied_all = tau.new_zeros(L), torch.ones(L, dtype=torch.bool, device=device)
+        steps = 2 if N > 0 else 0
+        for i in range(steps):
+            # candidate learning rates in Cayley transform of each layer [n, L], around its last one
+            taus = torch.tensor(layers[0].CAYLEY_STEPS, device=device).view(-1, 1) * tau
+            t = taus[:, owner].view(-1, N, 1, 1)
+
+            W = torch.einsum('gkn,gjn->gkj', G, R) # G_k R^T
+            U = torch.cat([P, -W], 1).transpose(1, 2)
+            V = torch.cat([W, P], 1).transpose(1, 2)
+            VtU = V.transpose(1, 2).bmm(U)
+            VtR = V.transpose(1, 2).bmm(R)
+            U_k = U[:, rows]
+            dF_0 = -0.5 * per_layer(U.transpose(1, 2).bmm(U) * V.transpose(1, 2).bmm(V)) # -0.5 |A|^2
+            F_X = per_layer(G * R[:, rows])
+            # all the candidates at once, [n, N, ...]
+            M_inv = (I + 0.5 * t * VtU).inverse()
+            M_inv_VtR = M_inv.matmul(VtR)
+            # rows of the concept axes of Y_tau
+            Y_tau = R[:, rows] - t * U_k.matmul(M_inv_VtR)
+            F_Y_tau = per_layer(G * Y_tau)
+            # tr(G^T (I + tau/2 A)^-1 A (R + Y_tau)/2), with V^T (R + Y_tau)/2 = V^T R - tau/2 V^T U M^-1 V^T R
+            VtZ = VtR - 0.5 * t * VtU.matmul(M_inv_VtR)
+            dF_tau = -per_layer(G * (U_k - 0.5 * t * U_k.matmul(M_inv).matmul(VtU)).matmul(VtZ))
+            satisfied = (F_Y_tau <= F_X + c1*taus*dF_0 + 1e-18) & (dF_tau + 1e-18 >= c2*dF_0)
+            # the candidates are in increasing order: the last one that satisfies the conditions, per layer
+            last = (satisfied.long() * torch.arange(1, taus.size(0) + 1, device=device).view(-1, 1)).argmax(0)
+            best = torch.where(satisfied.any(0), last, F_Y_tau.argmin(0))
+            tau = taus[best, layer_range]
+            R = R - tau[owner].view(-1, 1, 1) * U.bmm(M_inv_VtR[best[owner], torch.arange(N, device=device)])
+            objective = F_Y_tau[best, layer_range]
+            satisfied_all = satisfied_all & satisfied.any(0)
+
+        timer.stop()
+        stats = []
+        for i, layer in enumerate(layers):
+            layer_stats = {'steps': 0, 'candidates': 0, 'objective': None, 'satisfied': None, 'time': timer}
+            if active[i]:
+                running_rot = layer.running_rot.clone()
+                running_rot[groups[i]] = R[owner == i]
+                layer.running_rot = running_rot
+                layer.cayley_tau = tau[i]
+                layer_stats.update(steps=steps, candidates=len(layer.CAYLEY_STEPS) * steps, objective=objective[i],
+                                   satisfied=satisfied_all[i])
+            layer.counter = torch.ones_like(layer.counter) * 0.001
+            layer_stats['tau'] = layer.cayley_tau.clone()
+            stats.append(layer_stats)
+    return stats
+
+
+def _tangent(R, Z):
+    """
+    Projection of Z onto the tangent space of the rotations at R, Z - R sym(R^T Z) = (Z - R Z^T R) / 2
+    """
+    return 0.5 * (Z - R.bmm(Z.transpose(1, 2)).bmm(R))
+
+
+def _qr_retraction(Y):
+    Q, T = _qr(Y)
+    # the signs that make the diagonal of T positive, so that Q is close to Y
+    return Q * torch.sign(T.diagonal(dim1=-2, dim2=-1) + 1e-30).unsqueeze(1)
+
+
+def _polar_retraction(Y):
+    # U V^T, the closest rotation to Y (the closest matrix with orthonormal rows if Y is [k, C], k < C)
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'svd'):
+        U, _, Vh = torch.linalg.svd(Y, full_matrices=False)
+        return U.matmul(Vh)
+    U, _, V = torch.svd(Y)
+    return U.matmul(V.transpose(-2, -1))
+
+
+_retractions = {'qr': _qr_retraction, 'polar': _polar_retraction}
+
+
+def _procrustes_rotation(Y):
+    """
+    The rotation R (det 1) maximizing <R, Y> for a square Y: U diag(1, ..., 1, det(U V^T)) V^T
+    """
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'svd'):
+        U, _, Vh = torch.linalg.svd(Y)
+    else:
+        U, _, V = torch.svd(Y)
+        Vh = V.t()
+    U = U.clone()
+    U[:, -1] *= torch.sign(torch.det(U.matmul(Vh).double())).to(U)
+    return U.matmul(Vh)
+
+
+def _riemannian_update(layers):
+    """
+    Riemannian gradient step, with momentum ('sgd') or Adam ('adam'), followed by a retraction on the rotation
+    matrices of layers (see IterNormRotation). Returns the stats of each layer
+    """
+    stats = []
+    with torch.no_grad():
+        for layer in layers:
+            timer = _UpdateTimer(layer.running_rot.device)
+            layer_stats = {'steps': 0, 'candidates': 0, 'tau': torch.tensor(layer.rotation_lr), 'objective': None,
+                           'satisfied': None}
+            groups = layer.sum_G.abs().sum((1, 2)).nonzero().view(-1)
+            if groups.numel() > 0:
+                G = (layer.sum_G/layer.counter.reshape(*layer.sum_G.size()[:2], 1))[groups]
+                R = layer.running_rot[groups]
+                # Riemannian gradient of F = <G, R>
+                grad = _tangent(R, G)
+                if layer.rotation_optimizer == 'sgd':
+                    # the momentum of the previous steps, moved to the tangent space at R
+                    direction = layer.rotation_momentum * _tangent(R, layer.rot_momentum[groups]) + grad
+                    layer.rot_momentum[groups] = direction
+                else:
+                    beta1, beta2 = layer.rotation_momentum, 0.999
+                    layer.rot_step[groups] += 1
+                    step = layer.rot_step[groups].view(-1, 1, 1)
+                    exp_avg = beta1 * _tangent(R, layer.rot_exp_avg[groups]) + (1. - beta1) * grad
+                    exp_avg_sq = beta2 * layer.rot_exp_avg_sq[groups] + (1. - beta2) * grad ** 2
+                    layer.rot_exp_avg[groups] = exp_avg
+                    layer.rot_exp_avg_sq[groups] = exp_avg_sq
+                    direction = _tangent(R, (exp_avg / (1. - beta1 ** step)) /
+                                         ((exp_avg_sq / (1. - beta2 ** step)).sqrt() + 1e-8))
+                R = _retractions[layer.rotation_retraction](R - layer.rotation_lr * direction)
+                running_rot = layer.running_rot.clone()
+                running_rot[groups] = R
+                layer.running_rot = running_rot
+                layer_stats.update(steps=1, objective=(G * R).sum())
+            layer.counter = torch.ones_like(layer.counter) * 0.001
+            layer_stats['time'] = timer.stop()
+            stats.append(layer_stats)
+    return stats
+
+
+def _procrustes_update(layers):
+    """
+    Closed-form minimizer of <G, R> over the rotations (orthogonal Procrustes problem) for the rotation matrices
+    of layers (see IterNormRotation.procrustes_rotation). Returns the stats of each layer
+    """
+    stats = []
+    with torch.no_grad():
+        for layer in layers:
+            timer = _UpdateTimer(layer.running_rot.device)
+            layer_stats = {'steps': 0, 'candidates': 0, 'tau': None, 'objective': None, 'satisfied': None}
+            groups = layer.sum_G.abs().sum((1, 2)).nonzero().view(-1)
+            if groups.numel() > 0:
+                G = (layer.sum_G/layer.counter.reshape(*layer.sum_G.size()[:2], 1))[groups]
+                R = layer.running_rot[groups]
+                for i in range(groups.numel()):
+                    rows = G[i].abs().sum(1) != 0
+                    # the rows of the concept axes maximize <R_k, -G_k>: the polar factor U V^T of -G_k
+                    R_k = _polar_retraction(-G[i, rows])
+                    R[i, rows] = R_k
+                    if not rows.all():
+                        # the other rows, the closest orthonormal ones to their current value in the orthogonal
+                        # complement of the concept axes
+                        others = R[i, ~rows]
+                        R[i, ~rows] = _polar_retraction(others - others.matmul(R_k.t()).matmul(R_k))
+                    if torch.det(R[i].double()) < 0:
+                        if not rows.all():
+                            # a reflection: negating a row that is not a concept axis leaves <G, R> unchanged
+                            free = (~rows).nonzero()[-1, 0]
+                            R[i, free] = -R[i, free]
+                        else:
+                            # every row is a concept axis: the best rotation flips the singular direction of the
+                            # smallest singular value of -G
+                            R[i] = _procrustes_rotation(-G[i])
+                running_rot = layer.running_rot.clone()
+                running_rot[groups] = R
+                layer.running_rot = running_rot
+                layer_stats.update(steps=1, objective=(G * R).sum())
+            layer.counter = torch.ones_like(layer.counter) * 0.001
+            layer_stats['time'] = timer.stop()
+            stats.append(layer_stats)
+    return stats
+
+
+_rotation_updates = {'cayley': _cayley_update, 'sgd': _riemannian_update, 'adam': _riemannian_update,
+                     'procrustes': _procrustes_update}
+
+
+def update_rotation_matrices(layers, workers=4):
+    """
+    Update the rotation matrices of several IterNormRotation layers, e.g. all the CW layers of a model: the
+    layers whose rotations have the same size and device are updated in one batched solve (the Cayley ones,
+    the others one after another), and these batches run on a pool of workers threads. Returns the stats of
+    update_rotation_matrix of each layer, in order, where the time of a Cayley one is that of its batch
+    """
+    batches = collections.OrderedDict()
+    for i, layer in enumerate(layers):
+        key = (_rotation_updates[layer.rotation_optimizer], tuple(layer.running_rot.size()[1:]),
+               layer.running_rot.device)
+        batches.setdefault(key, []).append(i)
+
+    def update(key, batch):
+        return key[0]([layers[i] for i in batch])
+
+    batches = list(batches.items())
+    if len(batches) > 1 and workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(min(workers, len(batches))) as pool:
+            results = list(pool.map(lambda item: update(*item), batches))
+    else:
+        results = [update(*item) for item in batches]
+    batches = [batch for _, batch in batches]
+    stats = [None] * len(layers)
+    for batch, batch_stats in zip(batches, results):
+        for i, layer_stats in zip(batch, batch_stats):
+            stats[i] = layer_stats
+    return stats
+
+
+class AsyncRotationUpdater(object):
+    """
+    Rotation updates of IterNormRotation layers on a background thread, so that training does not wait
+    for the solves
+
+    submit() snapshots the accumulated gradients (sum_G, counter), running_rot and the optimizer state of
+    the layers and starts update_rotation_matrices on the snapshots; the layers keep training with their
+    current rotation. The new rotations (and optimizer state) are swapped in, between two training steps,
+    by step() once the solve is done, or after waiting for it once max_staleness training steps have
+    passed since submit(); max_staleness = 0 waits at once, i.e. is a synchronous update.
+
+    On GPU the solve runs on a dedicated CUDA stream, which waits for the snapshots to be taken on the
+    current stream; an event is recorded on it after the solve, and the current stream waits on that
+    event before the new rotations are swapped in, so the swap is ordered after the solve on the device
+    and not only on the host.
+    """
+    # buffers read and written by the rotation updates
+    BUFFERS = ('sum_G', 'counter', 'running_rot', 'cayley_tau', 'rot_momentum', 'rot_exp_avg', 'rot_exp_avg_sq',
+               'rot_step')
+
+    def __init__(self, layers, max_staleness=1):
+        self.layers = list(layers)
+        self.max_staleness = max_staleness
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._future = None
+        self._snapshots = None
+        self._steps = 0
+        self._stream = None
+        # stats of each layer of the last update swapped in
+        self.stats = None
+
+    def _snapshot(self, layer):
+        # a shallow copy of the layer with its own copy of the buffers of the update
+        snapshot = copy.copy(layer)
+        snapshot._buffers = collections.OrderedDict(layer._buffers)
+        for name in self.BUFFERS:
+            if name in layer._buffers:
+                snapshot._buffers[name] = layer._buffers[name].clone()
+        return snapshot
+
+    def submit(self):
+        """
+        Start the update of the rotations from the gradients accumulated so far, after swapping in the
+        pending one if any
+        """
+        self.wait()
+        with torch.no_grad():
+            self._snapshots = [self._snapshot(layer) for layer in self.layers]
+            # the accumulated gradients are consumed by this update, as in update_rotation_matrix
+            for layer in self.layers:
+                layer.counter = torch.ones_like(layer.counter) * 0.001
+        self._steps = 0
+        stream = None
+        device = self.layers[0].running_rot.device
+        if device.type == 'cuda':
+            if self._stream is None:
+                self._stream = torch.cuda.Stream(device)
+            stream = self._stream
+            # the solve reads the snapshots taken on the current stream
+            stream.wait_stream(torch.cuda.current_stream(device))
+            for snapshot in self._snapshots:
+                for name in self.BUFFERS:
+                    if name in snapshot._buffers:
+                        snapshot._buffers[name].record_stream(stream)
+        self._future = self._executor.submit(self._solve, self._snapshots, stream)
+        if self.max_staleness <= 0:
+            self.wait()
+
+    @staticmethod
+    def _solve(snapshots, stream):
+        if stream is None:
+            return update_rotation_matrices(snapshots, 1), None
+        with torch.cuda.stream(stream):
+            stats = update_rotation_matrices(snapshots, 1)
+            event = torch.cuda.Event()
+            event.record(stream)
+        return stats, event
+
+    def step(self):
+        """
+        Call after every training step: swaps in the new rotations if they are ready, or once they are
+        max_staleness steps old
+        """
+        if self._future is None:
+            return
+        self._steps += 1
+        if self._future.done() or self._steps >= self.max_staleness:
+            self.wait()
+
+    def wait(self):
+        """
+        Wait for the pending update, if any, and swap its rotations in, e.g. before evaluating or saving
+        """
+        if self._future is None:
+            return self.stats
+        self.stats, event = self._future.result()
+        current = None
+        if event is not None:
+            # order the swap, and every use of the new rotations, after the solve on the device
+            current = torch.cuda.current_stream(self.layers[0].running_rot.device)
+            current.wait_event(event)
+        with torch.no_grad():
+            for layer, snapshot in zip(self.layers, self._snapshots):
+                for name in self.BUFFERS:
+                    if name in layer._buffers and name not in ('sum_G', 'counter'):
+                        buffer = snapshot._buffers[name]
+                        if current is not None:
+                            # written on the solve stream, used from now on by the current one
+                            buffer.record_stream(current)
+                        setattr(layer, name, buffer)
+        self._future = None
+        self._snapshots = None
+        return self.stats
+
+
+class SyncIterNormRotation(IterNormRotation):
+    """
+    Concept Whitening Module for distributed training (SyncIterNorm), one process per device
+
+    In training, the per-group sums and outer products of the activations are all-reduced over
+    process_group (the default group if None) before the whitening iterations, so that every process
+    whitens with, and keeps running statistics of, the global batch. The concept gradients accumulated
+    in sum_G are averaged over the processes as well, which keeps running_rot identical on all of them.
+    Without an initialized process group it is the same as IterNormRotation.
+
+    """
+    def __init__(self, num_features, *args, process_group=None, **kwargs):
+        super(SyncIterNormRotation, self).__init__(num_features, *args, **kwargs)
+        self.process_group = process_group
+
+    def forward(self, X: torch.Tensor):
+        X_hat = super(SyncIterNormRotation, self).forward(X)
+        group = self._process_group()
+        if self.mode >= 0 and group is not None:
+            # every process accumulated the gradient of its own concept images, average them
+            with torch.no_grad():
+                concept_group, axis = divmod(self.mode, self.num_channels)
+                G, = _all_reduce(group, self.sum_G[concept_group, axis, :])
+                self.sum_G[concept_group, axis, :] = G / dist.get_world_size(group)
+        return X_hat
+
+    def _update_concept_rows(self, sums, counts):
+        group = self._process_group()
+        if group is not None:
+            # sum the concept gradients of all processes before taking their mean
+            sums, counts = _all_reduce(group, sums, counts)
+        super(SyncIterNormRotation, self)._update_concept_rows(sums, counts)
+
+    def _process_group(self):
+        if not dist.is_available() or not dist.is_initialized():
+            return None
+        group = dist.group.WORLD if self.process_group is None else self.process_group
+        return group if dist.get_world_size(group) > 1 else None
+
+    @classmethod
+    def convert_sync_iternorm(cls, module, process_group=None):
+        """
+        Replace all the IterNormRotation layers of module by SyncIterNormRotation ones, with the same
+        configuration, buffers and parameters
+        """
+        module_output = module
+        if isinstance(module, IterNormRotation) and not isinstance(module, cls):
+            module_output = cls(module.num_features, num_channels=module.num_channels, T=module.T, eps=module.eps,
+                                momentum=module.momentum, affine=module.affine, mode=module.mode,
+                                activation_mode=module.activation_mode, backend=module.backend,
+                                checkpoint=module.checkpoint, tol=module.tol, layout_aware=module.layout_aware,
+                                subsample=module.subsample, subsample_mode=module.subsample_mode,
+                                whiten_every=module.whiten_every, freeze_after=module.freeze_after,
+                                micro_batches=module.micro_batches, cross_iterations=module.cross_iterations,
+                                stale_decay=module.stale_decay, rank=module.rank,
+                                rotation_optimizer=module.rotation_optimizer,
+                                rotation_retraction=module.rotation_retraction, rotation_lr=module.rotation_lr,
+                                rotation_momentum=module.rotation_momentum,
+                                concept_projection=module.concept_projection, process_group=process_group)
+            module_output.load_state_dict(module.state_dict())
+            module_output.to(module.running_mean.device)
+            module_output.train(module.training)
+        for name, child in module.named_children():
+            module_output.add_module(name, cls.convert_sync_iternorm(child, process_group))
+        return module_output
 
 if __name__ == '__main__':
     ItN = IterNormRotation(64, num_groups=2, T=10, momentum=1, affine=False)
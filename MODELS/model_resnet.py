@@ -5,7 +5,54 @@ import torch.nn.functional as F
 import torchvision.models as models
 import math
 from torch.nn import init
-from .iterative_normalization import IterNormRotation as cw_layer
+from .iterative_normalization import IterNormRotation as cw_layer, update_rotation_matrices
+
+def cw_layer_kwargs(args):
+    """
+    Keyword arguments of the CW layers, taken from the command line arguments
+    """
+    return dict(activation_mode = args.act_mode, backend = args.whiten_backend, checkpoint = args.cw_checkpoint,
+                tol = args.cw_tol, layout_aware = args.cw_layout_aware, subsample = args.cw_subsample,
+                subsample_mode = args.cw_subsample_mode, whiten_every = args.cw_whiten_every,
+                freeze_after = args.cw_freeze_after, micro_batches = args.micro_batches,
+                cross_iterations = args.cw_cross_iterations, stale_decay = args.cw_stale_decay,
+                num_channels = args.cw_group_size, rank = args.cw_rank, rotation_optimizer = args.cw_rot_optimizer,
+                rotation_retraction = args.cw_rot_retraction, rotation_lr = args.cw_rot_lr,
+                rotation_momentum = args.cw_rot_momentum, concept_projection = args.cw_concept_projection)
+
+def cw_layers(model):
+    """
+    All the CW layers of a model, in forward order
+    """
+    return [m for m in model.modules() if isinstance(m, cw_layer)]
+
+def set_concept_labels(model, concept_labels):
+    """
+    Per-sample concept labels (-1 for none) of the next forward of all the CW layers of a model,
+    None for an ordinary forward
+    """
+    for layer in cw_layers(model):
+        layer.concept_labels = concept_labels
+
+def calibrate_cw_layers(model, loader, batches):
+    """
+    Set the running mean and whitening matrix of every CW layer of a model to those of the first batches
+    batches of loader, pooled, e.g. before fine-tuning from a model whose BatchNorm layers were replaced.
+    The layers are calibrated one after another, in forward order, so that each one sees the activations
+    whitened by the calibrated layers before it: one pass over the batches per CW layer
+    """
+    training = model.training
+    model.eval()
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        for layer in cw_layers(model):
+            layer.start_calibration()
+            for i, (input, _) in enumerate(loader):
+                if i == batches:
+                    break
+                model(input.to(device))
+            layer.stop_calibration()
+    model.train(training)
 
 class ResidualNetTransfer(nn.Module):
     def __init__(self, num_classes, args, whitened_layers=None, arch = 'resnet18', layers = [2,2,2,2], model_file = None):
@@ -28,13 +75,13 @@ class ResidualNetTransfer(nn.Module):
 
         for whitened_layer in whitened_layers:
             if whitened_layer <= layers[0]:
-                self.model.layer1[whitened_layer-1].bn1 = cw_layer(64, activation_mode = args.act_mode)
+                self.model.layer1[whitened_layer-1].bn1 = cw_layer(64, **cw_layer_kwargs(args))
             elif whitened_layer <= layers[0] + layers[1]:
-                self.model.layer2[whitened_layer-layers[0]-1].bn1 = cw_layer(128, activation_mode = args.act_mode)
+                self.model.layer2[whitened_layer-layers[0]-1].bn1 = cw_layer(128, **cw_layer_kwargs(args))
             elif whitened_layer <= layers[0] + layers[1] + layers[2]:
-                self.model.layer3[whitened_layer-layers[0]-layers[1]-1].bn1 = cw_layer(256, activation_mode = args.act_mode)
+                self.model.layer3[whitened_layer-layers[0]-layers[1]-1].bn1 = cw_layer(256, **cw_layer_kwargs(args))
             elif whitened_layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-                self.model.layer4[whitened_layer-layers[0]-layers[1]-layers[2]-1].bn1 = cw_layer(512, activation_mode = args.act_mode)
+                self.model.layer4[whitened_layer-layers[0]-layers[1]-layers[2]-1].bn1 = cw_layer(512, **cw_layer_kwargs(args))
     
     def change_mode(self, mode):
         """
@@ -55,20 +102,54 @@ class ResidualNetTransfer(nn.Module):
     
     def update_rotation_matrix(self):
         """
-        update the rotation R using accumulated gradient G
+        update the rotation R using accumulated gradient G, of all the CW layers at once
+        returns the stats (time, objective, ...) of each CW layer, in forward order
+        """
+        return update_rotation_matrices(cw_layers(self))
+
+    def procrustes_rotation_matrix(self):
+        """
+        set the rotation R of every CW layer to the closed-form best alignment with the accumulated gradient G,
+        e.g. as a warm start before training
+        """
+        return [layer.procrustes_rotation() for layer in cw_layers(self)]
+
+    def whitening_iterations(self):
+        """
+        Number of Newton-Schulz iterations taken by each CW layer in the last training step
+        """
+        return [layer.whitening_info.get('iterations') for layer in cw_layers(self)]
+
+    def calibrate_whitening(self, loader, batches):
+        """
+        Set the whitening statistics of the CW layers to the exact ones of batches batches of loader
+        """
+        calibrate_cw_layers(self, loader, batches)
+
+    def fuse(self):
+        """
+        Fold each CW layer into the conv1 right before it, for inference only
         """
         layers = self.layers
         for whitened_layer in self.whitened_layers:
             if whitened_layer <= layers[0]:
-                self.model.layer1[whitened_layer-1].bn1.update_rotation_matrix()
+                block = self.model.layer1[whitened_layer-1]
             elif whitened_layer <= layers[0] + layers[1]:
-                self.model.layer2[whitened_layer-layers[0]-1].bn1.update_rotation_matrix()
+                block = self.model.layer2[whitened_layer-layers[0]-1]
             elif whitened_layer <= layers[0] + layers[1] + layers[2]:
-                self.model.layer3[whitened_layer-layers[0]-layers[1]-1].bn1.update_rotation_matrix()
+                block = self.model.layer3[whitened_layer-layers[0]-layers[1]-1]
             elif whitened_layer <= layers[0] + layers[1] + layers[2] + layers[3]:
-                self.model.layer4[whitened_layer-layers[0]-layers[1]-layers[2]-1].bn1.update_rotation_matrix()
+                block = self.model.layer4[whitened_layer-layers[0]-layers[1]-layers[2]-1]
+            block.conv1 = block.bn1.fuse(block.conv1)
+            block.bn1 = nn.Identity()
+        return self
 
-    def forward(self, x):
+    def forward(self, x, concept_labels=None):
+        """
+        concept_labels: per-sample concept indices (-1 for none) of a mixed concept batch, whose gradients
+        are accumulated into the columns of G of all the concepts at once (in eval mode, with mode = -1)
+        """
+        set_concept_labels(self, concept_labels)
         return self.model(x)
 
 class DenseNetTransfer(nn.Module):
@@ -89,15 +170,15 @@ class DenseNetTransfer(nn.Module):
         self.whitened_layers = whitened_layers
         for whitened_layer in whitened_layers:
             if whitened_layer == 1:
-                self.model.features.norm0 = cw_layer(64, activation_mode = args.act_mode)
+                self.model.features.norm0 = cw_layer(64, **cw_layer_kwargs(args))
             elif whitened_layer == 2:
-                self.model.features.transition1.norm = cw_layer(384, activation_mode = args.act_mode)
+                self.model.features.transition1.norm = cw_layer(384, **cw_layer_kwargs(args))
             elif whitened_layer == 3:
-                self.model.features.transition2.norm = cw_layer(768, activation_mode = args.act_mode)
+                self.model.features.transition2.norm = cw_layer(768, **cw_layer_kwargs(args))
             elif whitened_layer == 4:
-                self.model.features.transition3.norm = cw_layer(2112, activation_mode = args.act_mode)
+                self.model.features.transition3.norm = cw_layer(2112, **cw_layer_kwargs(args))
             elif whitened_layer == 5:
-                self.model.features.norm5 = cw_layer(2208, activation_mode = args.act_mode)
+                self.model.features.norm5 = cw_layer(2208, **cw_layer_kwargs(args))
     
     def change_mode(self, mode):
         """
@@ -119,21 +200,55 @@ class DenseNetTransfer(nn.Module):
     
     def update_rotation_matrix(self):
         """
-        update the rotation R using accumulated gradient G
+        update the rotation R using accumulated gradient G, of all the CW layers at once
+        returns the stats (time, objective, ...) of each CW layer, in forward order
+        """
+        return update_rotation_matrices(cw_layers(self))
+
+    def procrustes_rotation_matrix(self):
+        """
+        set the rotation R of every CW layer to the closed-form best alignment with the accumulated gradient G,
+        e.g. as a warm start before training
+        """
+        return [layer.procrustes_rotation() for layer in cw_layers(self)]
+    
+    def whitening_iterations(self):
+        """
+        Number of Newton-Schulz iterations taken by each CW layer in the last training step
+        """
+        return [layer.whitening_info.get('iterations') for layer in cw_layers(self)]
+
+    def calibrate_whitening(self, loader, batches):
+        """
+        Set the whitening statistics of the CW layers to the exact ones of batches batches of loader
+        """
+        calibrate_cw_layers(self, loader, batches)
+
+    def fuse(self):
+        """
+        Fold the CW layers for inference only: norm0 into conv0, the transition ones
+        (followed by ReLU, not preceded by a convolution) into a 1x1 convolution
         """
         for whitened_layer in self.whitened_layers:
             if whitened_layer == 1:
-                self.model.features.norm0.update_rotation_matrix()
+                self.model.features.conv0 = self.model.features.norm0.fuse(self.model.features.conv0)
+                self.model.features.norm0 = nn.Identity()
             elif whitened_layer == 2:
-                self.model.features.transition1.norm.update_rotation_matrix()
+                self.model.features.transition1.norm = self.model.features.transition1.norm.fuse()
             elif whitened_layer == 3:
-                self.model.features.transition2.norm.update_rotation_matrix()
+                self.model.features.transition2.norm = self.model.features.transition2.norm.fuse()
             elif whitened_layer == 4:
-                self.model.features.transition3.norm.update_rotation_matrix()
+                self.model.features.transition3.norm = self.model.features.transition3.norm.fuse()
             elif whitened_layer == 5:
-                self.model.features.norm5.update_rotation_matrix()
-    
-    def forward(self, x):
+                self.model.features.norm5 = self.model.features.norm5.fuse()
+        return self
+
+    def forward(self, x, concept_labels=None):
+        """
+        concept_labels: per-sample concept indices (-1 for none) of a mixed concept batch, whose gradients
+        are accumulated into the columns of G of all the concepts at once (in eval mode, with mode = -1)
+        """
+        set_concept_labels(self, concept_labels)
         return self.model(x)
 
 class VGGBNTransfer(nn.Module):
@@ -159,7 +274,7 @@ class VGGBNTransfer(nn.Module):
                 channel = 256
             else:
                 channel = 512
-            self.model.features[self.layers[whitened_layer]] = cw_layer(channel, activation_mode = args.act_mode)
+            self.model.features[self.layers[whitened_layer]] = cw_layer(channel, **cw_layer_kwargs(args))
 
     def change_mode(self, mode):
         """
@@ -173,13 +288,47 @@ class VGGBNTransfer(nn.Module):
     
     def update_rotation_matrix(self):
         """
-        update the rotation R using accumulated gradient G
+        update the rotation R using accumulated gradient G, of all the CW layers at once
+        returns the stats (time, objective, ...) of each CW layer, in forward order
+        """
+        return update_rotation_matrices(cw_layers(self))
+
+    def procrustes_rotation_matrix(self):
+        """
+        set the rotation R of every CW layer to the closed-form best alignment with the accumulated gradient G,
+        e.g. as a warm start before training
+        """
+        return [layer.procrustes_rotation() for layer in cw_layers(self)]
+
+    def whitening_iterations(self):
+        """
+        Number of Newton-Schulz iterations taken by each CW layer in the last training step
+        """
+        return [layer.whitening_info.get('iterations') for layer in cw_layers(self)]
+
+    def calibrate_whitening(self, loader, batches):
+        """
+        Set the whitening statistics of the CW layers to the exact ones of batches batches of loader
+        """
+        calibrate_cw_layers(self, loader, batches)
+
+    def fuse(self):
+        """
+        Fold each CW layer into the convolution right before it, for inference only
         """
         layers = self.layers
         for whitened_layer in self.whitened_layers:
-            self.model.features[layers[whitened_layer-1]].update_rotation_matrix()
+            self.model.features[layers[whitened_layer-1]-1] = \
+                self.model.features[layers[whitened_layer-1]].fuse(self.model.features[layers[whitened_layer-1]-1])
+            self.model.features[layers[whitened_layer-1]] = nn.Identity()
+        return self
 
-    def forward(self, x):
+    def forward(self, x, concept_labels=None):
+        """
+        concept_labels: per-sample concept indices (-1 for none) of a mixed concept batch, whose gradients
+        are accumulated into the columns of G of all the concepts at once (in eval mode, with mode = -1)
+        """
+        set_concept_labels(self, concept_labels)
         return self.model(x)
 
 class ResidualNetBN(nn.Module):
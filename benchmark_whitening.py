@@ -0,0 +1,585 @@
+"""
+Micro-benchmarks of the whitening layers in MODELS/iterative_normalization.py
+
+    python3 benchmark_whitening.py layout --batch-size 64 --channels 64 --size 56
+    python3 benchmark_whitening.py sync --world-size 2 --batch-size 16 --channels 64 --size 14
+    python3 benchmark_whitening.py subsample --batch-size 64 --channels 64 --size 56
+    python3 benchmark_whitening.py fuse --batch-size 1 --size 224
+    python3 benchmark_whitening.py lowrank --batch-size 32 --ranks 16,64,128
+    python3 benchmark_whitening.py concepts --batch-size 64 --channels 512 --size 28
+    python3 benchmark_whitening.py cayley --concepts 8
+    python3 benchmark_whitening.py rotation --concepts 8 --updates 20
+"""
+import argparse
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from MODELS.iterative_normalization import IterNorm, IterNormRotation, SyncIterNormRotation
+from MODELS.model_resnet import ResidualNetTransfer, cw_layers
+
+parser = argparse.ArgumentParser(description='Whitening micro-benchmarks')
+parser.add_argument('benchmark', choices=['layout', 'sync', 'subsample', 'fuse', 'lowrank', 'concepts', 'cayley',
+                                          'rotation'])
+parser.add_argument('-b', '--batch-size', default=64, type=int, metavar='N',
+                    help='mini-batch size (default: 64)')
+parser.add_argument('--channels', default=64, type=int, metavar='C',
+                    help='number of channels of the whitened layer (default: 64)')
+parser.add_argument('--size', default=56, type=int, metavar='S',
+                    help='height and width of the feature map (default: 56)')
+parser.add_argument('--repeats', default=10, type=int, metavar='N',
+                    help='number of timed repetitions (default: 10)')
+parser.add_argument('--cuda', dest='cuda', action='store_true',
+                    help='run on the GPU')
+parser.add_argument('--world-size', default=2, type=int, metavar='N',
+                    help='number of CPU processes of the sync benchmark, over gloo (default: 2)')
+parser.add_argument('--fractions', default='0.5,0.25,0.125,0.0625', type=str,
+                    help='comma delimited fractions of spatial positions of the subsample benchmark')
+parser.add_argument('--whitened_layers', default='5', type=str,
+                    help='comma delimited whitened layers of the ResNet-18 of the fuse benchmark (default: 5)')
+parser.add_argument('--ranks', default='16,64,128', type=str,
+                    help='comma delimited ranks of the lowrank benchmark')
+parser.add_argument('--steps', default=50, type=int, metavar='N',
+                    help='training steps fitting the whitening (and subspace) of the lowrank benchmark (default: 50)')
+parser.add_argument('--concepts', default=8, type=int, metavar='K',
+                    help='number of concept axes of the lowrank, cayley and rotation benchmarks (default: 8)')
+parser.add_argument('--updates', default=20, type=int, metavar='N',
+                    help='number of rotation updates of the lowrank and rotation benchmarks (default: 20)')
+
+# Activation-sized reads + writes of one training step (forward, backward) of the whitening function, the
+# activation part of the analytic estimate printed next to the measured allocations.
+# transposed copies: in-copy (2), mean (1), centering (2), covariance (2), whitening (2), out-copy (2) /
+#                    grad-copy (2), g_wm (2), mean of grad (1), centering of grad (2), wm^T g (2), g_sigma xc (3),
+#                    out-copy (2)
+# layout-aware:      mean (1), covariance (2), whitening (2) /
+#                    sum of grad (1), g_wm (2), wm^T g (2), g_sigma x added in place (3)
+ACTIVATION_PASSES = {False: (11, 14), True: (5, 8)}
+
+
+def estimated_traffic(size, layout_aware, channels_last):
+    """
+    Analytic estimate of the bytes read + written by a training step (forward, backward) of a single-group float32
+    whitening of an input of shape size: the ACTIVATION_PASSES plus the d x d products of the covariance (forward)
+    and of g_wm (backward). The Newton-Schulz iterations on the d x d matrices are the same on all paths.
+    """
+    N, C, H, W = size
+    hw = H * W
+    activation, matrix = N * C * hw * 4, C * C * 4
+    forward, backward = ACTIVATION_PASSES[layout_aware]
+    forward, backward = forward * activation, backward * activation
+    if not layout_aware or channels_last:
+        # a single GEMM writes the product
+        return forward + matrix, backward + matrix
+    if hw >= C:
+        # N [d, d] partial products written, then summed
+        return forward + 2 * N * matrix, backward + 2 * N * matrix
+    # transposed copies of 1/8 of the batch (of x, and of the gradient in backward), one GEMM accumulated per copy
+    return forward + 2 * activation + 16 * matrix, backward + 4 * activation + 16 * matrix
+
+
+def allocated_bytes(fn, cuda):
+    """
+    Total bytes allocated while running fn, from the CUDA caching allocator or the CPU memory profiler
+    """
+    if cuda:
+        torch.cuda.synchronize()
+        before = torch.cuda.memory_stats()['allocated_bytes.all.allocated']
+        fn()
+        torch.cuda.synchronize()
+        return torch.cuda.memory_stats()['allocated_bytes.all.allocated'] - before
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(max(event.self_cpu_memory_usage, 0) for event in prof.events())
+
+
+def step_allocations(layer, X, cuda):
+    """
+    Bytes allocated by the forward and by the backward of a training step of layer on X
+    """
+    X.grad = None
+    out = []
+    forward = allocated_bytes(lambda: out.append(layer(X).sum()), cuda)
+    backward = allocated_bytes(lambda: out[0].backward(), cuda)
+    return forward, backward
+
+
+def time_step(layer, X, repeats, cuda):
+    """
+    Best time (ms) of a training forward + backward of layer on X
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        X.grad = None
+        if cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        layer(X).sum().backward()
+        if cuda:
+            torch.cuda.synchronize()
+        best = min(best, (time.time() - start) * 1000)
+    return best
+
+
+def benchmark_layout(args):
+    device = 'cuda' if args.cuda else 'cpu'
+    size = (args.batch_size, args.channels, args.size, args.size)
+    activation_bytes = torch.Size(size).numel() * 4
+    print('Input {}, one activation = {:.1f} MB'.format(size, activation_bytes / 2 ** 20))
+    configs = [('transposed copies', False, False),
+               ('layout-aware NCHW', True, False),
+               ('layout-aware channels_last', True, True)]
+    for name, layout_aware, channels_last in configs:
+        layer = IterNorm(args.channels, affine=False, layout_aware=layout_aware).to(device)
+        layer.train()
+        X = torch.randn(*size, device=device)
+        if channels_last:
+            X = X.contiguous(memory_format=torch.channels_last)
+        X.requires_grad_()
+        ms = time_step(layer, X, args.repeats, args.cuda)
+        forward, backward = step_allocations(layer, X, args.cuda)
+        forward_traffic, backward_traffic = estimated_traffic(size, layout_aware, channels_last)
+        print('{:28s} {:8.2f} ms   allocated: forward {:7.1f} MB, backward {:7.1f} MB   '
+              'estimated traffic: forward {:7.1f} MB, backward {:7.1f} MB'.format(
+                  name, ms, forward / 2 ** 20, backward / 2 ** 20, forward_traffic / 2 ** 20,
+                  backward_traffic / 2 ** 20))
+
+
+def sync_worker(rank, args, X, grad, Y, X_grad):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    dist.init_process_group('gloo', rank=rank, world_size=args.world_size)
+    torch.set_num_threads(1)
+    layer = SyncIterNormRotation(args.channels)
+    layer.train()
+    # every process whitens its own shard of the batch
+    shard = slice(rank * args.batch_size, (rank + 1) * args.batch_size)
+    x = X[shard].clone().requires_grad_()
+    y = layer(x)
+    y.backward(grad[shard])
+    errors = torch.tensor([(y - Y[shard]).abs().max().item(), (x.grad - X_grad[shard]).abs().max().item()])
+    dist.all_reduce(errors, op=dist.ReduceOp.MAX)
+    ms = time_step(layer, x, args.repeats, False)
+    if rank == 0:
+        print('synchronized, {} processes x batch {}: {:8.2f} ms   max error: output {:.2e}, input grad {:.2e}'.format(
+            args.world_size, args.batch_size, ms, errors[0].item(), errors[1].item()))
+    dist.destroy_process_group()
+
+
+def benchmark_sync(args):
+    size = (args.world_size * args.batch_size, args.channels, args.size, args.size)
+    print('Global batch {}'.format(size))
+    X = torch.randn(*size)
+    grad = torch.randn(*size)
+    # reference: a single process whitening the global batch
+    layer = IterNormRotation(args.channels)
+    layer.train()
+    x = X.clone().requires_grad_()
+    Y = layer(x)
+    Y.backward(grad)
+    X_grad = x.grad.clone()
+    torch.set_num_threads(1)
+    ms = time_step(layer, x, args.repeats, False)
+    print('single process, batch {}: {:8.2f} ms'.format(size[0], ms))
+    mp.spawn(sync_worker, args=(args, X, grad, Y.detach(), X_grad), nprocs=args.world_size)
+
+
+def whitening_error(Y):
+    """
+    ||cov(Y) - I||_F / sqrt(C) of an N x C x H x W output, over all of its positions
+    """
+    y = Y.detach().transpose(0, 1).reshape(Y.size(1), -1).double()
+    y = y - y.mean(1, keepdim=True)
+    eye = torch.eye(y.size(0), dtype=y.dtype, device=y.device)
+    return ((y.matmul(y.t()) / y.size(1) - eye).norm() / y.size(0) ** 0.5).item()
+
+
+def subsampled_whitening_reference(X, subset, T, eps):
+    """
+    Newton-Schulz whitening with the statistics of the positions subset, in plain autograd operations
+    """
+    N, C, H, W = X.size()
+    x = X.reshape(N, C, H * W)
+    x_s = x[:, :, subset].transpose(0, 1).reshape(C, -1)
+    mean = x_s.mean(1, keepdim=True)
+    xc = x_s - mean
+    eye = torch.eye(C, dtype=X.dtype)
+    Sigma = xc.matmul(xc.t()) / xc.size(1) + eps * eye
+    rTr = 1. / Sigma.trace()
+    Sigma_N = Sigma * rTr
+    P = eye
+    for _ in range(T):
+        P = 1.5 * P - 0.5 * P.matmul(P).matmul(P).matmul(Sigma_N)
+    wm = P * rTr.sqrt()
+    return torch.einsum('dc,nch->ndh', wm, x - mean.view(1, C, 1)).reshape(N, C, H, W)
+
+
+def benchmark_subsample(args):
+    device = 'cuda' if args.cuda else 'cpu'
+    size = (args.batch_size, args.channels, args.size, args.size)
+    print('Input {}'.format(size))
+    X = torch.randn(*size, device=device)
+    # correlated channels, so that the whitening has something to undo
+    X = torch.einsum('dc,nchw->ndhw', torch.randn(args.channels, args.channels, device=device) / args.channels ** 0.5,
+                     X) + X
+    X.requires_grad_()
+    configs = [('full', None, 'fixed')]
+    for fraction in args.fractions.split(','):
+        configs.extend([('{} fixed'.format(fraction), float(fraction), 'fixed'),
+                        ('{} random'.format(fraction), float(fraction), 'random')])
+    # the error is measured with the exact eigh whitening: 5 Newton-Schulz iterations are far from converged on
+    # these inputs and their own error hides the one of the subsampling
+    baseline, Y_full = None, None
+    for name, subsample, subsample_mode in configs:
+        layer = IterNorm(args.channels, affine=False, layout_aware=True, subsample=subsample,
+                         subsample_mode=subsample_mode).to(device)
+        layer.train()
+        ms = time_step(layer, X, args.repeats, args.cuda)
+        baseline = baseline or ms
+        layer = IterNorm(args.channels, affine=False, layout_aware=True, backend='eigh', subsample=subsample,
+                         subsample_mode=subsample_mode).to(device)
+        layer.train()
+        with torch.no_grad():
+            Y = layer(X).double()
+        Y_full = Y if Y_full is None else Y_full
+        print('{:16s} {:8.2f} ms   time / full {:5.2f}   whitening error {:.4f}   distance to full {:.4f}'.format(
+            name, ms, ms / baseline, whitening_error(Y), ((Y - Y_full).norm() / Y_full.norm()).item()))
+    # backward of the subsampled estimator against autograd through the same computation, in double
+    layer = IterNorm(8, affine=False, T=5, subsample=0.3, subsample_mode='random').double()
+    layer.train()
+    x = torch.randn(4, 8, 6, 6, dtype=torch.double, requires_grad=True)
+    grad = torch.randn(4, 8, 6, 6, dtype=torch.double)
+    y = layer(x)
+    y.backward(grad)
+    x_ref = x.detach().clone().requires_grad_()
+    y_ref = subsampled_whitening_reference(x_ref, layer.whitening_info['subset'], layer.T, layer.eps)
+    y_ref.backward(grad)
+    print('max error against autograd: output {:.2e}, input grad {:.2e}'.format(
+        (y - y_ref).abs().max().item(), (x.grad - x_ref.grad).abs().max().item()))
+
+
+def time_inference(model, X, repeats, cuda):
+    """
+    Best time (ms) of an inference forward of model on X
+    """
+    best = float('inf')
+    with torch.no_grad():
+        for _ in range(repeats):
+            if cuda:
+                torch.cuda.synchronize()
+            start = time.time()
+            model(X)
+            if cuda:
+                torch.cuda.synchronize()
+            best = min(best, (time.time() - start) * 1000)
+    return best
+
+
+def benchmark_fuse(args):
+    device = 'cuda' if args.cuda else 'cpu'
+    # command line arguments of the CW layers, as in train_places.py
+    cw_args = argparse.Namespace(act_mode='pool_max', whiten_backend='newton', cw_checkpoint=False, cw_tol=None,
+                                 cw_layout_aware=False, cw_subsample=None, cw_subsample_mode='fixed',
+                                 cw_whiten_every=1, cw_freeze_after=None, micro_batches=1, cw_cross_iterations=0,
+                                 cw_stale_decay=1., cw_group_size=None, cw_rank=None,
+                                 cw_rot_optimizer='cayley', cw_rot_retraction='qr', cw_rot_lr=0.1,
+                                 cw_rot_momentum=0.9, cw_concept_projection=False)
+    whitened_layers = [int(x) for x in args.whitened_layers.split(',')]
+    model = ResidualNetTransfer(365, cw_args, whitened_layers, arch='resnet18', layers=[2, 2, 2, 2]).to(device)
+    with torch.no_grad():
+        # a non-trivial whitening and rotation, as after training
+        for layer in cw_layers(model):
+            C = layer.num_features
+            A = torch.randn(C, C, device=device) / C ** 0.5
+            layer.running_mean = torch.randn(1, C, 1, device=device)
+            layer.running_wm = (torch.eye(C, device=device) + 0.1 * (A + A.t())).unsqueeze(0)
+            layer.running_rot = torch.svd(torch.randn(C, C, device=device))[0].unsqueeze(0)
+    model.eval()
+    X = torch.randn(args.batch_size, 3, args.size, args.size, device=device)
+    with torch.no_grad():
+        Y = model(X)
+    ms = time_inference(model, X, args.repeats, args.cuda)
+    print('Input {}, whitened layers {}'.format(tuple(X.size()), whitened_layers))
+    print('{:12s} {:8.2f} ms'.format('CW', ms))
+    model.fuse()
+    with torch.no_grad():
+        error = (model(X) - Y).abs().max().item()
+    ms = time_inference(model, X, args.repeats, args.cuda)
+    print('{:12s} {:8.2f} ms   max output error {:.2e}'.format('fused CW', ms, error))
+    plain = ResidualNetTransfer(365, cw_args, [], arch='resnet18', layers=[2, 2, 2, 2]).to(device)
+    plain.eval()
+    print('{:12s} {:8.2f} ms'.format('plain ResNet', time_inference(plain, X, args.repeats, args.cuda)))
+
+
+def concept_batch(mixing, directions, batch_size, S):
+    """
+    Activations [N, C, S, S] with a decaying spectrum, as after a trained convolution, where each sample is
+    shifted along the direction of its concept (3 standard deviations before the mixing), and their concepts [N]
+    """
+    C, k = mixing.size(0), directions.size(0)
+    labels = torch.randint(k, (batch_size,), device=mixing.device)
+    z = torch.randn(batch_size, C, S, S, device=mixing.device) + 3. * directions[labels].view(batch_size, C, 1, 1)
+    return torch.einsum('dc,nchw->ndhw', mixing, z), labels
+
+
+def benchmark_lowrank(args):
+    device = 'cuda' if args.cuda else 'cpu'
+    # the wide CW layers of ResNet50 and DenseNet161: (name, channels, feature map size)
+    configs = [('ResNet50 layer4', 2048, 7), ('DenseNet161 transition3', 2112, 14), ('DenseNet161 norm5', 2208, 7)]
+    ranks = [None] + [int(r) for r in args.ranks.split(',')]
+    k = args.concepts
+    for name, C, S in configs:
+        print('{}: input {}'.format(name, (args.batch_size, C, S, S)))
+        mixing = torch.randn(C, C, device=device) * torch.linspace(1., 0.05, C, device=device)
+        directions = torch.nn.functional.normalize(torch.randn(k, C, device=device), dim=1)
+        X = concept_batch(mixing, directions, args.batch_size, S)[0].requires_grad_()
+        for rank in ranks:
+            layer = IterNormRotation(C, rank=rank, activation_mode='mean', momentum=0.3).to(device)
+            layer.train()
+            ms = time_step(layer, X, args.repeats, args.cuda)
+            with torch.no_grad():
+                # fit the whitening and the subspace
+                for _ in range(args.steps):
+                    layer(concept_batch(mixing, directions, args.batch_size, S)[0])
+                layer.eval()
+                # align the concept axes, as in train_places.py
+                for _ in range(args.updates):
+                    X_c, labels = concept_batch(mixing, directions, args.batch_size, S)
+                    layer.concept_labels = labels
+                    layer(X_c)
+                    layer.concept_labels = None
+                    layer.update_rotation_matrix()
+                # concept accuracy: the concept axis with the largest mean activation is the one of the sample
+                X_c, labels = concept_batch(mixing, directions, 4 * args.batch_size, S)
+                accuracy = (layer(X_c)[:, :k].mean((2, 3)).argmax(1) == labels).double().mean().item()
+                y = layer(X.detach()).transpose(0, 1).reshape(C, -1).double()
+            y = y - y.mean(1, keepdim=True)
+            corr = y.matmul(y.t()) / y.size(1)
+            std = corr.diagonal().sqrt()
+            corr = corr / std.view(-1, 1) / std.view(1, -1)
+            eye = torch.eye(C, dtype=corr.dtype, device=device)
+            # the concept axes should be white, and as decorrelated as possible from the other channels
+            concept_error = (corr[:k, :k] - eye[:k, :k]).abs().max().item()
+            cross = corr[:k, k:].abs().max().item()
+            print('  {:10s} {:9.2f} ms   concept axes: max |corr - I| {:.2e}, max |corr| with other channels {:.3f}'
+                  '   concept accuracy {:.3f}'.format('full' if rank is None else 'rank {}'.format(rank), ms,
+                                                      concept_error, cross, accuracy))
+
+
+def masked_dense_concept_gradient(layer, X_hat):
+    """
+    Concept gradient [g, c] of X_hat [b, g, c, h, w] as computed before the index-based estimators,
+    with the full rotation, dense masks and, for pool_max, an unpooling
+    """
+    size_X = (X_hat.size(0), -1, X_hat.size(3), X_hat.size(4))
+    X_test = torch.einsum('bgchw,gdc->bgdhw', X_hat, layer.running_rot)
+    if layer.activation_mode == 'mean':
+        return -X_hat.mean((0, 3, 4))
+    elif layer.activation_mode == 'max':
+        max_values = torch.max(torch.max(X_test, 3, keepdim=True)[0], 4, keepdim=True)[0]
+        max_bool = max_values == X_test
+        grad = -((X_hat * max_bool.to(X_hat)).sum((3, 4)) / max_bool.to(X_hat).sum((3, 4)))
+    elif layer.activation_mode == 'pos_mean':
+        pos_bool = X_test > 0
+        grad = -((X_hat * pos_bool.to(X_hat)).sum((3, 4)) / (pos_bool.to(X_hat).sum((3, 4)) + 0.0001))
+    elif layer.activation_mode == 'pool_max':
+        X_test_nchw = X_test.reshape(size_X)
+        maxpool_value, maxpool_indices = layer.maxpool(X_test_nchw)
+        X_test_unpool = layer.maxunpool(maxpool_value, maxpool_indices, output_size=X_test_nchw.size())
+        maxpool_bool = X_test == X_test_unpool.view(X_test.size())
+        grad = -((X_hat * maxpool_bool.to(X_hat)).sum((3, 4)) / (maxpool_bool.to(X_hat).sum((3, 4))))
+    return grad.mean(0)[0]
+
+
+def dense_concept_gradient(layer, X_hat):
+    """
+    Gradient [c] of the activation of concept 0 on X_hat [b, g, c, h, w], the activations before the rotation,
+    with a full rotation, dense masks of the concept channel and, for pool_max, an unpooling (concept_projection)
+    """
+    X_test = torch.einsum('bgchw,gdc->bgdhw', X_hat, layer.running_rot)
+    # the mask of the concept channel, for every channel
+    x_concept = X_test[:, 0, :1]
+    if layer.activation_mode == 'mean':
+        return -X_hat[:, 0].mean((0, 2, 3))
+    elif layer.activation_mode == 'max':
+        mask = x_concept == x_concept.amax((2, 3), keepdim=True)
+    elif layer.activation_mode == 'pos_mean':
+        mask = x_concept > 0
+    elif layer.activation_mode == 'pool_max':
+        maxpool_value, maxpool_indices = layer.maxpool(x_concept)
+        mask = x_concept == layer.maxunpool(maxpool_value, maxpool_indices, output_size=x_concept.size())
+    mask = mask.to(X_hat)
+    eps = 0.0001 if layer.activation_mode == 'pos_mean' else 0.
+    return -((X_hat[:, 0] * mask).sum((2, 3)) / (mask.sum((2, 3)) + eps)).mean(0)
+
+
+def time_function(fn, repeats, cuda):
+    """
+    Best time (ms) of fn(), and its result
+    """
+    best = float('inf')
+    with torch.no_grad():
+        for _ in range(repeats):
+            if cuda:
+                torch.cuda.synchronize()
+            start = time.time()
+            out = fn()
+            if cuda:
+                torch.cuda.synchronize()
+            best = min(best, (time.time() - start) * 1000)
+    return best, out
+
+
+def benchmark_concepts(args):
+    device = 'cuda' if args.cuda else 'cpu'
+    size = (args.batch_size, args.channels, args.size, args.size)
+    print('Input {}, concept update of axis 0'.format(size))
+    X = torch.randn(*size, device=device)
+    R = torch.svd(torch.randn(args.channels, args.channels, device=device))[0].unsqueeze(0)
+    configs = [(activation_mode, concept_projection) for concept_projection in [False, True]
+               for activation_mode in ['mean', 'max', 'pos_mean', 'pool_max']]
+    for activation_mode, concept_projection in configs:
+        layer = IterNormRotation(args.channels, activation_mode=activation_mode, momentum=1.,
+                                 concept_projection=concept_projection).to(device)
+        # in eval mode with the initial running mean and whitening matrix, the activations before the rotation are X
+        layer.eval()
+        layer.running_rot = R.clone()
+        layer.mode = 0
+        with torch.no_grad():
+            layer(X)
+        X_hat = X.view(args.batch_size, layer.num_groups, layer.num_channels, args.size, args.size)
+        concepts = torch.zeros(args.batch_size, dtype=torch.long, device=device)
+        # the estimators alone, on the activations the layer hands them: before the rotation for the masked one,
+        # after it for the projected one (the dense references rotate the activation themselves)
+        if concept_projection:
+            dense = dense_concept_gradient
+            X_rot = torch.einsum('bgchw,gdc->bgdhw', X_hat, layer.running_rot)
+            ms, _ = time_function(lambda: layer._concept_gradients(X_rot, concepts).mean(0), args.repeats, args.cuda)
+        else:
+            dense = masked_dense_concept_gradient
+            ms, _ = time_function(lambda: layer._masked_concept_gradients(X_hat, concepts).mean(0), args.repeats,
+                                  args.cuda)
+        best, reference = time_function(lambda: dense(layer, X_hat), args.repeats, args.cuda)
+        error = (layer.sum_G[0, 0] - reference).abs().max().item()
+        print('{:10s} {:9s} dense {:8.2f} ms   index-based {:8.2f} ms   max |sum_G - dense sum_G| {:.2e}'.format(
+            activation_mode, 'projected' if concept_projection else 'masked', best, ms, error))
+
+
+def dense_cayley_update(G, R):
+    """
+    The rotation update of IterNormRotation.update_rotation_matrix on G and R [g, C, C], with [C, C] inverses
+    and a bisection line search restarted from tau = 1000
+    """
+    for i in range(2):
+        tau, alpha, beta, c1, c2 = 1000, 0, 100000000, 1e-4, 0.9
+        A = torch.einsum('gin,gjn->gij', G, R) - torch.einsum('gin,gjn->gij', R, G)
+        I = torch.eye(R.size(2), device=R.device).expand(*R.size())
+        dF_0 = -0.5 * (A ** 2).sum()
+        for cnt in range(501):
+            inv = (I + 0.5 * tau * A).inverse()
+            Y_tau = torch.bmm(torch.bmm(inv, I - 0.5 * tau * A), R)
+            F_X = (G * R).sum()
+            F_Y_tau = (G * Y_tau).sum()
+            dF_tau = -torch.bmm(torch.einsum('gni,gnj->gij', G, inv), torch.bmm(A, 0.5 * (R + Y_tau))).diagonal(
+                dim1=-2, dim2=-1).sum()
+            if F_Y_tau > F_X + c1 * tau * dF_0 + 1e-18:
+                beta = tau
+                tau = (beta + alpha) / 2
+            elif dF_tau + 1e-18 < c2 * dF_0:
+                alpha = tau
+                tau = (beta + alpha) / 2
+            else:
+                break
+        R = torch.bmm(torch.bmm((I + 0.5 * tau * A).inverse(), I - 0.5 * tau * A), R)
+    return R
+
+
+def benchmark_cayley(args):
+    device = 'cuda' if args.cuda else 'cpu'
+    k = args.concepts
+    for C in [512, 2048, 2208]:
+        layer = IterNormRotation(C).to(device)
+        R = torch.svd(torch.randn(C, C, device=device))[0].unsqueeze(0)
+        G = torch.zeros(1, C, C, device=device)
+        G[0, :k] = -torch.randn(k, C, device=device)
+        layer.sum_G = G.clone()
+        layer.counter = torch.ones(C, device=device)
+        layer.running_rot = R.clone()
+        if args.cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        stats = layer.update_rotation_matrix()
+        if args.cuda:
+            torch.cuda.synchronize()
+        ms = (time.time() - start) * 1000
+        start = time.time()
+        with torch.no_grad():
+            reference = dense_cayley_update(G, R)
+        if args.cuda:
+            torch.cuda.synchronize()
+        dense_ms = (time.time() - start) * 1000
+        R_new = layer.running_rot[0].double()
+        eye = torch.eye(C, dtype=R_new.dtype, device=device)
+        print('C={:5d}, {} concepts: dense {:10.2f} ms, objective {:.4f}   '
+              'batched low-rank {:8.2f} ms, objective {:.4f} (tau {:.3g}, {} candidates, conditions satisfied: {})   '
+              'max |R R^T - I| {:.2e}'.format(
+                  C, k, dense_ms, (G * reference).sum().item(), ms, (G * layer.running_rot).sum().item(),
+                  stats['tau'].item(), stats['candidates'], bool(stats['satisfied']),
+                  (R_new.matmul(R_new.t()) - eye).abs().max().item()))
+
+
+def benchmark_rotation(args):
+    device = 'cuda' if args.cuda else 'cpu'
+    k = args.concepts
+    optimizers = [('cayley', 'qr'), ('sgd', 'qr'), ('sgd', 'polar'), ('adam', 'qr'), ('adam', 'polar'),
+                  ('procrustes', 'qr')]
+    checkpoints = sorted({1, min(5, args.updates), args.updates})
+    for C in [64, 256, 512, 2048]:
+        # concept gradients of k concepts, the best alignment <G, R> over the rotations is -|G|_* (nuclear norm)
+        G = torch.zeros(1, C, C, device=device)
+        G[0, :k] = -torch.randn(k, C, device=device).abs()
+        best = -torch.svd(G[0])[1].sum().item()
+        print('C={}, {} concepts: alignment <G, R> / -|G|_* after {} updates'.format(C, k, checkpoints))
+        for optimizer, retraction in optimizers:
+            layer = IterNormRotation(C, rotation_optimizer=optimizer, rotation_retraction=retraction).to(device)
+            alignment, total = [], 0.
+            for update in range(1, args.updates + 1):
+                layer.sum_G = G.clone()
+                layer.counter = torch.ones(C, device=device)
+                if args.cuda:
+                    torch.cuda.synchronize()
+                start = time.time()
+                layer.update_rotation_matrix()
+                if args.cuda:
+                    torch.cuda.synchronize()
+                total += time.time() - start
+                if update in checkpoints:
+                    alignment.append((G * layer.running_rot).sum().item() / best)
+            name = optimizer if optimizer in ('cayley', 'procrustes') else '{} ({})'.format(optimizer, retraction)
+            print('  {:14s} {:8.2f} ms / update   alignment {}'.format(
+                name, total * 1000 / args.updates, ', '.join('{:.3f}'.format(a) for a in alignment)))
+
+
+def main():
+    args = parser.parse_args()
+    if args.benchmark == 'layout':
+        benchmark_layout(args)
+    elif args.benchmark == 'sync':
+        benchmark_sync(args)
+    elif args.benchmark == 'subsample':
+        benchmark_subsample(args)
+    elif args.benchmark == 'fuse':
+        benchmark_fuse(args)
+    elif args.benchmark == 'lowrank':
+        benchmark_lowrank(args)
+    elif args.benchmark == 'concepts':
+        benchmark_concepts(args)
+    elif args.benchmark == 'cayley':
+        benchmark_cayley(args)
+    elif args.benchmark == 'rotation':
+        benchmark_rotation(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -84,18 +84,8 @@ def plot_concept_top50(
     outputs = []
 
     def hook(module, input, output):
-        from MODELS.iterative_normalization import iterative_normalization_py
-
-        X_hat = iterative_normalization_py.apply(
-            input[0], module.running_mean, module.running_wm,
-            module.num_channels, module.T, module.eps, module.momentum,
-            module.training)
-        size_X = X_hat.size()
-        size_R = module.running_rot.size()
-        X_hat = X_hat.view(size_X[0], size_R[0], size_R[2], *size_X[2:])
-        X_hat = torch.einsum('bgchw,gdc->bgdhw', X_hat, module.running_rot)
-        X_hat = X_hat.view(*size_X)
-        outputs.append(X_hat.cpu().numpy())
+        # in eval mode the output of the CW layer (affine=False) is the rotated whitened activation
+        outputs.append(output.cpu().numpy())
 
     for layer in layer_list:
         layer = int(layer)
@@ -202,23 +192,8 @@ def get_layer_representation(args, val_loader, layer, cpt_idx, time):
         outputs = []
 
         def hook(module, input, output):
-            from MODELS.iterative_normalization import (
-                iterative_normalization_py)
-
-            # print(input)
-            X_hat = iterative_normalization_py.apply(
-                input[0], module.running_mean, module.running_wm,
-                module.num_channels, module.T, module.eps, module.momentum,
-                module.training)
-            size_X = X_hat.size()
-            size_R = module.running_rot.size()
-            X_hat = X_hat.view(size_X[0], size_R[0], size_R[2], *size_X[2:])
-
-            X_hat = torch.einsum('bgchw,gdc->bgdhw', X_hat, module.running_rot)
-            # print(size_X)
-            X_hat = X_hat.view(*size_X)
-
-            outputs.append(X_hat.cpu().numpy())
+            # in eval mode the output of the CW layer (affine=False) is the rotated whitened activation
+            outputs.append(output.cpu().numpy())
 
         layer = int(layer)
         if layer <= layers[0]:
@@ -541,19 +516,8 @@ def plot_auc_cw(args, time, conceptdir, whitened_layers, path_plots,
                 outputs= []
             
                 def hook(module, input, output):
-                    from MODELS.iterative_normalization import iterative_normalization_py
-                    #print(input)
-                    X_hat = iterative_normalization_py.apply(input[0], module.running_mean, module.running_wm, module.num_channels, module.T,
-                                                            module.eps, module.momentum, module.training)
-                    size_X = X_hat.size()
-                    size_R = module.running_rot.size()
-                    X_hat = X_hat.view(size_X[0], size_R[0], size_R[2], *size_X[2:])
-
-                    X_hat = torch.einsum('bgchw,gdc->bgdhw', X_hat, module.running_rot)
-                    #print(size_X)
-                    X_hat = X_hat.view(*size_X)
-
-                    outputs.append(X_hat.cpu().numpy())
+                    # in eval mode the output of the CW layer (affine=False) is the rotated whitened activation
+                    outputs.append(output.cpu().numpy())
                     
                 layer = int(layer)
                 if layer <= layers[0]:
@@ -927,20 +891,8 @@ def plot_concept_representation(
         outputs = []
 
         def hook(module, input, output):
-            from MODELS.iterative_normalization import (
-                iterative_normalization_py)
-
-            X_hat = iterative_normalization_py.apply(
-                input[0], module.running_mean, module.running_wm,
-                module.num_channels, module.T, module.eps, module.momentum,
-                module.training)
-            size_X = X_hat.size()
-            size_R = module.running_rot.size()
-            X_hat = X_hat.view(size_X[0], size_R[0], size_R[2], *size_X[2:])
-
-            X_hat = torch.einsum('bgchw,gdc->bgdhw', X_hat, module.running_rot)
-            X_hat = X_hat.view(*size_X)
-            outputs.append(X_hat.cpu().numpy())
+            # in eval mode the output of the CW layer (affine=False) is the rotated whitened activation
+            outputs.append(output.cpu().numpy())
 
         for layer in layer_list:
             layer = int(layer)
@@ -19,6 +19,7 @@ import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import torchvision.models as models
 from MODELS.model_resnet import *
+from MODELS.iterative_normalization import AsyncRotationUpdater
 from plot_functions import *
 from PIL import ImageFile, Image
 
@@ -36,6 +37,56 @@ parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet',
                     ' (default: resnet18)')
 parser.add_argument('--whitened_layers', default='8')
 parser.add_argument('--act_mode', default='pool_max')
+parser.add_argument('--whiten_backend', default='newton',
+                    help='whitening backend of the CW layers: newton | eigh | cholesky | auto')
+parser.add_argument('--cw_checkpoint', dest='cw_checkpoint', action='store_true',
+                    help='recompute the whitening intermediates in backward to save memory')
+parser.add_argument('--cw_tol', default=None, type=float,
+                    help='stop the whitening iterations once the residual is below this tolerance')
+parser.add_argument('--cw_layout_aware', dest='cw_layout_aware', action='store_true',
+                    help='whiten NCHW/channels_last memory directly instead of transposed copies')
+parser.add_argument('--cw_subsample', default=None, type=float,
+                    help='estimate the whitening statistics from this fraction of the spatial positions')
+parser.add_argument('--cw_subsample_mode', default='fixed', choices=['fixed', 'random'],
+                    help='spatial positions used by --cw_subsample: fixed (central block) | '
+                         'random (block at a random offset)')
+parser.add_argument('--cw_whiten_every', default=1, type=int, metavar='K',
+                    help='recompute the whitening matrix every K training steps, reuse the running one in between')
+parser.add_argument('--cw_freeze_after', default=None, type=int, metavar='N',
+                    help='whiten with the running statistics only after N training steps')
+parser.add_argument('--micro_batches', default=1, type=int, metavar='K',
+                    help='process each batch as K micro-batches with accumulated gradients; '
+                         'the CW layers whiten with moments pooled over them')
+parser.add_argument('--cw_cross_iterations', default=0, type=int, metavar='K',
+                    help='combine the covariance of each batch with those of the previous K iterations')
+parser.add_argument('--cw_stale_decay', default=1., type=float,
+                    help='weight decay per iteration of age of the previous covariances')
+parser.add_argument('--cw_group_size', default=None, type=int, metavar='D',
+                    help='whiten groups of D channels (block-diagonal whitening), default: all channels')
+parser.add_argument('--cw_rank', default=None, type=int, metavar='R',
+                    help='whiten and rotate only the coordinates in the top-R eigenspace of the running covariance '
+                         '(the concept axes among them) and standardize the residual')
+parser.add_argument('--cw_rot_optimizer', default='cayley', type=str, choices=['cayley', 'sgd', 'adam', 'procrustes'],
+                    help='update of the concept rotation: Cayley transform with line search, Riemannian SGD '
+                         'with momentum / Adam, or closed-form Procrustes solution (default: cayley)')
+parser.add_argument('--cw_rot_retraction', default='qr', type=str, choices=['qr', 'polar'],
+                    help='retraction onto the rotations of the sgd and adam rotation optimizers (default: qr)')
+parser.add_argument('--cw_rot_lr', default=0.1, type=float, metavar='LR',
+                    help='learning rate of the sgd and adam rotation optimizers (default: 0.1)')
+parser.add_argument('--cw_rot_momentum', default=0.9, type=float, metavar='M',
+                    help='momentum (beta1 for adam) of the sgd and adam rotation optimizers (default: 0.9)')
+parser.add_argument('--cw_concept_projection', dest='cw_concept_projection', action='store_true',
+                    help='take the concept updates on the rotated output, with the masks of the concept channel '
+                         'only, instead of masking each rotated channel')
+parser.add_argument('--cw_procrustes_init', dest='cw_procrustes_init', action='store_true',
+                    help='make the first update of the concept rotation the closed-form Procrustes solution '
+                         '(warm start from the identity)')
+parser.add_argument('--cw_async_rotation', default=0, type=int, metavar='K',
+                    help='solve the rotation updates on a background thread, the new rotation is used at most '
+                         'K training steps later (default: 0, synchronous updates)')
+parser.add_argument('--cw_calibrate', default=0, type=int, metavar='N',
+                    help='before training, set the whitening statistics of the CW layers to those of N training '
+                         'batches (default: 0, off)')
 parser.add_argument('--depth', default=18, type=int, metavar='D',
                     help='model depth')
 parser.add_argument('--ngpu', default=4, type=int, metavar='G',
@@ -213,6 +264,9 @@ def main():
     if args.evaluate == False:
         print("Start training")
         best_prec1 = 0
+        if args.cw_calibrate > 0 and args.arch in ("resnet_cw", "densenet_cw", "vgg16_cw"):
+            # exact whitening statistics of the pretrained features, instead of the identity
+            model.module.calibrate_whitening(train_loader, args.cw_calibrate)
         for epoch in range(args.start_epoch, args.start_epoch + 2):
             adjust_learning_rate(optimizer, epoch)
 
@@ -297,6 +351,8 @@ def train(train_loader, concept_loaders, model, criterion, optimizer, epoch):
 
     # switch to train mode
     model.train()
+    rotation_updater = AsyncRotationUpdater(cw_layers(model), args.cw_async_rotation) \
+        if args.cw_async_rotation > 0 else None
 
     end = time.time()
     for i, (input, target) in enumerate(train_loader):
@@ -305,16 +361,23 @@ def train(train_loader, concept_loaders, model, criterion, optimizer, epoch):
         if (i + 1) % 30 == 0:
             model.eval()
             with torch.no_grad():
-                # update the gradient matrix G
+                # update the gradient matrix G, from one batch of every concept in a single forward
+                X, labels = [], []
                 for concept_index, concept_loader in enumerate(concept_loaders):
-                    model.module.change_mode(concept_index)
-                    for j, (X, _) in enumerate(concept_loader):
-                        X_var = torch.autograd.Variable(X).cuda()
-                        model(X_var)
-                        break
-                model.module.update_rotation_matrix()
-                # change to ordinary mode
-                model.module.change_mode(-1)
+                    X_concept, _ = next(iter(concept_loader))
+                    X.append(X_concept)
+                    labels.append(torch.full((X_concept.size(0),), concept_index, dtype=torch.long))
+                # shuffled, so that every GPU gets samples of all the concepts
+                order = torch.randperm(sum(x.size(0) for x in X))
+                model(torch.cat(X)[order].cuda(), torch.cat(labels)[order].cuda())
+                if args.cw_procrustes_init and epoch == args.start_epoch and i + 1 == 30:
+                    # warm start: the closed-form alignment, once the running whitening statistics have settled
+                    model.module.procrustes_rotation_matrix()
+                elif rotation_updater is not None:
+                    # solved in the background, while training goes on with the current rotation
+                    rotation_updater.submit()
+                else:
+                    model.module.update_rotation_matrix()
             model.train()
         # measure data loading time
         data_time.update(time.time() - end)
@@ -323,20 +386,30 @@ def train(train_loader, concept_loaders, model, criterion, optimizer, epoch):
         input_var = torch.autograd.Variable(input)
         target_var = torch.autograd.Variable(target)
 
-        # compute output
-        output = model(input_var)
-        loss = criterion(output, target_var)
+        # compute output and gradient, micro-batch by micro-batch
+        optimizer.zero_grad()
+        outputs = []
+        loss = 0
+        for input_chunk, target_chunk in zip(input_var.chunk(args.micro_batches), target_var.chunk(args.micro_batches)):
+            output_chunk = model(input_chunk)
+            loss_chunk = criterion(output_chunk, target_chunk) * input_chunk.size(0) / input.size(0)
+            loss_chunk.backward()
+            outputs.append(output_chunk.data)
+            loss += loss_chunk.data
+        output = torch.cat(outputs)
 
         # measure accuracy and record loss
         prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
-        losses.update(loss.data, input.size(0))
+        losses.update(loss, input.size(0))
         top1.update(prec1[0], input.size(0))
         top5.update(prec5[0], input.size(0))
 
-        # compute gradient and do SGD step
-        optimizer.zero_grad()
-        loss.backward()
+        # do SGD step, the next batch starts a new window of pooled whitening moments
         optimizer.step()
+        for layer in cw_layers(model):
+            layer.reset_moments()
+        if rotation_updater is not None:
+            rotation_updater.step()
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -351,6 +424,12 @@ def train(train_loader, concept_loaders, model, criterion, optimizer, epoch):
                   'Prec@5 {top5.val:.3f} ({top5.avg:.3f})'.format(
                       epoch, i, len(train_loader), batch_time=batch_time,
                       data_time=data_time, loss=losses, top1=top1, top5=top5))
+            if args.cw_tol is not None:
+                print('Whitening iterations per CW layer: {}'.format(
+                    model.module.whitening_iterations()))
+    if rotation_updater is not None:
+        # the last rotations, before validation and checkpointing
+        rotation_updater.wait()
 
 
 def validate(val_loader, model, criterion, epoch):